@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+
+import metrics
+from session_store import SessionStore
+
+
+class TurnRejected(Exception):
+    """Raised if a turn is not admitted. The status code and the seconds after which the client may retry
+    are returned to the client."""
+
+    def __init__(self, message: str, status_code: int, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class SessionQueue:
+    """The turns of a session waiting for or holding the lock of the session"""
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.turns = 0
+        # the token of the lock of the session in the session store, held by the turn holding the lock
+        self.token = None
+
+
+class AdmissionController:
+    """Processes the turns of a session one after another and limits the turns processed at once.
+    Turns exceeding the limit wait in a bounded queue. If the queue is full or a turn waits too long,
+    the turn is rejected right away instead of piling up requests to ChatGPT.
+    The limits apply to the current process. The turns of a session are also serialized across processes
+    by locking the session in the session store the processes share."""
+
+    def __init__(self, max_concurrent_turns: int = 100, max_waiting_turns: int = 200, max_waiting_time: float = 10,
+                 max_turns_per_session: int = 3, session_store: SessionStore | None = None):
+        self.max_concurrent_turns = max_concurrent_turns
+        self.max_waiting_turns = max_waiting_turns
+        self.max_waiting_time = max_waiting_time
+        # a running turn and the retries or double clicks queued behind it
+        self.max_turns_per_session = max_turns_per_session
+        self.session_store = session_store
+        self.running_turns = 0
+        self.waiting_turns = 0
+        self.__slots = asyncio.Semaphore(max_concurrent_turns)
+        self.__sessions = {}
+
+    @asynccontextmanager
+    async def admit(self, session_id: str):
+        """Waits until the turn may be processed, raises TurnRejected if it is not admitted"""
+        await self.acquire(session_id)
+        try:
+            yield
+        finally:
+            await self.release(session_id)
+
+    async def acquire(self, session_id: str):
+        """Like admit, for turns which end in another task, e.g. streamed responses. Call release afterwards."""
+        session_queue = self.__sessions.setdefault(session_id, SessionQueue())
+        if session_queue.turns >= self.max_turns_per_session:
+            self.__reject('session', session_id)
+            raise TurnRejected("Please wait for the answer to your previous message.", 429, 1)
+        session_queue.turns += 1
+        try:
+            await self.__lock_local_session(session_id, session_queue)
+            try:
+                await self.__lock_session(session_id, session_queue)
+                try:
+                    await self.__acquire_slot(session_id)
+                except BaseException:
+                    await self.__unlock_session(session_id, session_queue)
+                    raise
+            except BaseException:
+                session_queue.lock.release()
+                raise
+        except BaseException:
+            self.__leave(session_id, session_queue)
+            raise
+        self.running_turns += 1
+
+    async def release(self, session_id: str):
+        self.running_turns -= 1
+        self.__slots.release()
+        session_queue = self.__sessions[session_id]
+        try:
+            await self.__unlock_session(session_id, session_queue)
+        finally:
+            session_queue.lock.release()
+            self.__leave(session_id, session_queue)
+
+    def statistics(self) -> dict:
+        return {'running_turns': self.running_turns, 'waiting_turns': self.waiting_turns,
+                'sessions': len(self.__sessions)}
+
+    async def __acquire_slot(self, session_id: str):
+        if not self.__slots.locked():
+            await self.__slots.acquire()
+            return
+        if self.waiting_turns >= self.max_waiting_turns:
+            self.__reject('queue_full', session_id)
+            raise TurnRejected("The chatbot is very busy at the moment. Please try again in a few seconds.", 503, 5)
+        self.waiting_turns += 1
+        try:
+            await asyncio.wait_for(self.__slots.acquire(), self.max_waiting_time)
+        except asyncio.TimeoutError:
+            self.__reject('timeout', session_id)
+            raise TurnRejected("The chatbot is very busy at the moment. Please try again in a few seconds.", 503, 5)
+        finally:
+            self.waiting_turns -= 1
+
+    async def __lock_local_session(self, session_id: str, session_queue: SessionQueue):
+        """Waits until no other turn of the session is processed by this process"""
+        try:
+            await asyncio.wait_for(session_queue.lock.acquire(), self.max_waiting_time)
+        except asyncio.TimeoutError:
+            self.__reject('session_locked', session_id)
+            raise TurnRejected("Please wait for the answer to your previous message.", 429, 1)
+
+    async def __lock_session(self, session_id: str, session_queue: SessionQueue):
+        """Waits until no turn of the session is processed by another process"""
+        if self.session_store is None:
+            return
+        session_queue.token = await self.session_store.lock(session_id, self.max_waiting_time)
+        if session_queue.token is None:
+            self.__reject('session_locked', session_id)
+            raise TurnRejected("Please wait for the answer to your previous message.", 429, 1)
+
+    async def __unlock_session(self, session_id: str, session_queue: SessionQueue):
+        if self.session_store is not None and session_queue.token is not None:
+            token, session_queue.token = session_queue.token, None
+            await self.session_store.unlock(session_id, token)
+
+    def __leave(self, session_id: str, session_queue: SessionQueue):
+        session_queue.turns -= 1
+        if session_queue.turns == 0:
+            del self.__sessions[session_id]
+
+    @staticmethod
+    def __reject(reason: str, session_id: str):
+        logging.warning("Rejected a turn of session %s: %s", session_id, reason)
+        metrics.rejected_turns.inc(reason)
+
+
+def create_admission_controller(session_store: SessionStore | None = None) -> AdmissionController:
+    """Creates the admission controller configured by the environment variables MAX_CONCURRENT_TURNS,
+    MAX_WAITING_TURNS, MAX_WAITING_SECONDS and MAX_TURNS_PER_SESSION"""
+    return AdmissionController(int(os.environ.get('MAX_CONCURRENT_TURNS', 100)),
+                               int(os.environ.get('MAX_WAITING_TURNS', 200)),
+                               float(os.environ.get('MAX_WAITING_SECONDS', 10)),
+                               int(os.environ.get('MAX_TURNS_PER_SESSION', 3)),
+                               session_store)
@@ -0,0 +1,264 @@
+"""Local stand-ins for the ChatGPT API and duckling, which answer after a configurable latency.
+
+The ChatGPT stand-in answers state queries with the tables of the conversations in training/structured-output.jsonl.
+Function calls for the booking information are answered with the values of the same tables, converted to the types
+of the function parameters.
+A value of the table is only returned once the user mentioned it, all values are returned after the last message
+of the conversation. Any other request is answered with a short fixed response."""
+import asyncio
+import datetime
+import json
+import random
+import re
+import time
+
+from aiohttp import web
+from dateutil import parser
+
+from history_manager import count_message_tokens, count_tokens
+from slot_schema import booking_slots
+
+state_query_marker = 'List all booking-relevant information'
+default_dataset = 'training/structured-output.jsonl'
+not_provided_table = '\n'.join(f"| {slot.table_key} | [not provided] |" for slot in booking_slots)
+reply = "Thank you! Could you please tell me how many guests will stay at our hotel?"
+
+
+def load_conversations(path: str = default_dataset) -> list[dict]:
+    """Returns the user messages and the expected state table of every conversation of the dataset"""
+    conversations = []
+    with open(path) as file:
+        for line in file:
+            messages = json.loads(line)['messages']
+            conversations.append({
+                'user_messages': [message['content'] for message in messages
+                                  if message['role'] == 'user' and message['content'].find(state_query_marker) == -1],
+                'messages': messages[:-2],
+                'table': messages[-1]['content']
+            })
+    return conversations
+
+
+class Latency:
+    """A normally distributed latency in seconds"""
+
+    def __init__(self, mean: float, jitter: float = 0.0):
+        self.mean = mean
+        self.jitter = jitter
+
+    async def wait(self):
+        await asyncio.sleep(max(random.gauss(self.mean, self.jitter), 0.0))
+
+
+class FakeOpenAi:
+    def __init__(self, latency: Latency, dataset: str = default_dataset):
+        self.latency = latency
+        self.requests = 0
+        self.conversations = load_conversations(dataset)
+        # user message -> list of (conversation index, message index) the message occurs in
+        self.occurrences = {}
+        for conversation_index, conversation in enumerate(self.conversations):
+            for message_index, message in enumerate(conversation['user_messages']):
+                self.occurrences.setdefault(message, []).append((conversation_index, message_index))
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self.chat_completions)
+        return app
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests += 1
+        await self.latency.wait()
+        messages = body['messages']
+        if 'functions' in body:
+            return self.create_function_call_response(body['model'], messages, body['functions'][0]['name'])
+        content = self.create_state_table(messages) if messages[-1]['content'].find(state_query_marker) > -1 \
+            else reply
+        if body.get('stream'):
+            return await self.stream(request, body['model'], content)
+        return web.json_response({
+            'id': 'chatcmpl-fake',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body['model'],
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': self.create_usage(messages, content)
+        })
+
+    def create_state_table(self, messages: list) -> str:
+        user_messages = [message['content'] for message in messages[:-1] if message['role'] == 'user']
+        match = self.find_conversation(user_messages)
+        if match is None:
+            return not_provided_table
+        conversation_index, message_index = match
+        conversation = self.conversations[conversation_index]
+        if message_index == len(conversation['user_messages']) - 1:
+            return conversation['table']
+        mentioned = ' '.join(conversation['user_messages'][:message_index + 1]).lower()
+        rows = []
+        for row in conversation['table'].split('\n'):
+            cells = [cell.strip() for cell in row.strip().strip('|').split('|')]
+            if len(cells) == 2 and mentioned.find(cells[1].lower()) == -1:
+                cells[1] = '[not provided]'
+            rows.append(f"| {' | '.join(cells)} |")
+        return '\n'.join(rows)
+
+    def create_function_call_response(self, model: str, messages: list, function_name: str) -> web.Response:
+        arguments = json.dumps(self.create_function_arguments(messages))
+        message = {'role': 'assistant', 'content': None,
+                   'function_call': {'name': function_name, 'arguments': arguments}}
+        return web.json_response({
+            'id': 'chatcmpl-fake',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{'index': 0, 'message': message, 'finish_reason': 'function_call'}],
+            'usage': self.create_usage(messages, arguments)
+        })
+
+    def create_function_arguments(self, messages: list) -> dict:
+        """Returns the values of the state table with the types of the json schemas of the slots"""
+        slots = {slot.table_key.lower(): slot for slot in booking_slots}
+        arguments = {}
+        for row in self.create_state_table(messages).split('\n'):
+            cells = [cell.strip() for cell in row.strip().strip('|').split('|')]
+            slot = slots.get(cells[0].lower()) if len(cells) == 2 else None
+            if slot is None or cells[1].find('not provided') > -1:
+                continue
+            arguments[slot.attribute] = self.convert_value(slot.dim, cells[1])
+        return arguments
+
+    @staticmethod
+    def convert_value(dim: str, text: str):
+        """Converts the value like ChatGPT would, values it could not convert stay text"""
+        match dim:
+            case 'bool':
+                return text.lower().find('yes') > -1
+            case 'time':
+                parsed = FakeDuckling.parse_time(text.lower())
+                if parsed is not None:
+                    return parsed['value'][:10]
+            case 'duration':
+                parsed = FakeDuckling.parse_duration(text.lower()) or FakeDuckling.parse_number(text.lower())
+                if parsed is not None:
+                    return parsed['normalized']['value'] // (24 * 3600) if 'normalized' in parsed \
+                        else parsed['value']
+            case 'number':
+                parsed = FakeDuckling.parse_number(text.lower())
+                if parsed is not None:
+                    return parsed['value']
+        return text
+
+    def find_conversation(self, user_messages: list) -> tuple[int, int] | None:
+        """Returns the conversation most of the user messages occur in and the index of the last message.
+        Ambiguous messages like '2' are assigned to the first conversation they occur in."""
+        matches = {}
+        for message in user_messages:
+            for conversation_index, message_index in self.occurrences.get(message, []):
+                count, last_index = matches.get(conversation_index, (0, 0))
+                matches[conversation_index] = (count + 1, max(last_index, message_index))
+        if len(matches) == 0:
+            return None
+        conversation_index = max(matches, key=lambda index: (matches[index][0], -index))
+        return conversation_index, matches[conversation_index][1]
+
+    @staticmethod
+    def create_usage(messages: list, content: str) -> dict:
+        prompt_tokens, completion_tokens = count_message_tokens(messages), count_tokens(content)
+        return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens}
+
+    @staticmethod
+    async def stream(request: web.Request, model: str, content: str) -> web.StreamResponse:
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for word in re.findall(r'\S+\s*', content):
+            chunk = {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                     'model': model, 'choices': [{'index': 0, 'delta': {'content': word}, 'finish_reason': None}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+
+number_words = {'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6, 'seven': 7, 'eight': 8, 'nine': 9,
+                'ten': 10, 'a': 1, 'an': 1}
+duration_units = {'night': 1, 'day': 1, 'week': 7}
+
+
+class FakeDuckling:
+    """Parses the values of the dataset well enough to imitate the results of duckling"""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.requests = 0
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/parse', self.parse)
+        app.router.add_get('/', self.health)
+        return app
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.Response(text='quack!')
+
+    async def parse(self, request: web.Request) -> web.Response:
+        data = await request.post()
+        self.requests += 1
+        await self.latency.wait()
+        dimension = data['dims'].strip('[]"')
+        value = {'time': self.parse_time, 'duration': self.parse_duration, 'number': self.parse_number,
+                 'email': self.parse_email}[dimension](data['text'].lower())
+        if value is None:
+            return web.json_response([])
+        return web.json_response([{'dim': dimension, 'body': data['text'], 'value': value}])
+
+    @staticmethod
+    def parse_number(text: str) -> dict | None:
+        match = re.search(r'\d+(\.\d+)?', text)
+        if match is not None:
+            return {'value': float(match.group()) if match.group(1) else int(match.group())}
+        for word in re.findall(r'[a-z]+', text):
+            if word in number_words:
+                return {'value': number_words[word]}
+        return None
+
+    @staticmethod
+    def parse_duration(text: str) -> dict | None:
+        match = re.search(r'(\d+|[a-z]+)\s+(night|day|week)s?', text)
+        if match is None:
+            return None
+        count = int(match.group(1)) if match.group(1).isdigit() else number_words.get(match.group(1))
+        if count is None:
+            return None
+        days = count * duration_units[match.group(2)]
+        return {'value': count, 'unit': match.group(2), 'normalized': {'value': days * 24 * 3600, 'unit': 'second'}}
+
+    @staticmethod
+    def parse_email(text: str) -> dict | None:
+        match = re.search(r'[\w.+-]+@[\w-]+\.[\w.]+', text)
+        return {'value': match.group()} if match is not None else None
+
+    @staticmethod
+    def parse_time(text: str) -> dict | None:
+        today = datetime.date.today()
+        if text.find('tomorrow') > -1:
+            date = today + datetime.timedelta(days=1)
+        elif text.find('today') > -1:
+            date = today
+        else:
+            try:
+                date = parser.parse(text, fuzzy=True, default=datetime.datetime.combine(today, datetime.time())).date()
+            except (ValueError, OverflowError):
+                return None
+            if date < today and not re.search(r'\d{4}', text):
+                date = date.replace(year=date.year + 1)
+        value = datetime.datetime.combine(date, datetime.time(), tzinfo=datetime.timezone.utc)
+        return {'value': value.isoformat(timespec='milliseconds'), 'grain': 'day'}
+
+
+async def start_app(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
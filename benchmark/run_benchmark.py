@@ -0,0 +1,181 @@
+"""Replays the conversations of the dataset through the chat endpoint of the server and measures the latency.
+
+ChatGPT and duckling are replaced by the local stand-ins of fake_servers.py, so neither an openAI key nor
+docker is required. Run it from the root folder of the project with `python -m benchmark.run_benchmark`.
+The results are compared with a baseline stored per mode of the state extraction, a regression ends the benchmark
+with exit code 1. Duckling only parses the values of the state table, so it is only called in table mode."""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+from benchmark.fake_servers import FakeDuckling, FakeOpenAi, Latency, load_conversations, start_app
+
+default_baseline = os.path.join(os.path.dirname(__file__), 'baseline.json')
+# metrics compared with the baseline and whether higher values are better
+compared_metrics = {'p50': False, 'p95': False, 'p99': False, 'throughput': True}
+
+
+def percentile(samples: list, percentile: float) -> float:
+    """Returns the nearest-rank percentile (0..1) of the samples"""
+    if len(samples) == 0:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(int(percentile * len(ordered)), len(ordered) - 1)]
+
+
+def summarize(samples: list) -> dict:
+    return {'count': len(samples), 'mean': sum(samples) / len(samples) if len(samples) > 0 else 0.0,
+            'p50': percentile(samples, 0.5), 'p95': percentile(samples, 0.95), 'p99': percentile(samples, 0.99)}
+
+
+def parse_server_timing(header: str) -> dict:
+    """Returns the total duration in seconds of every stage listed in the Server-Timing header"""
+    durations = defaultdict(float)
+    for entry in header.split(','):
+        stage, _, duration = entry.strip().partition(';dur=')
+        if duration:
+            durations[stage] += float(duration) / 1000
+    return durations
+
+
+async def replay_conversation(http, url: str, session_id: str, user_messages: list, latencies: list,
+                              stages: dict):
+    for index, text in enumerate(user_messages):
+        start = time.perf_counter()
+        # the trace id makes the server report the durations of the stages of the turn
+        async with http.post(url, json={'text': text, 'sessionId': session_id},
+                             headers={'X-Trace-Id': f'{session_id}-{index}'}) as response:
+            response.raise_for_status()
+            await response.json()
+        latencies.append(time.perf_counter() - start)
+        for stage, duration in parse_server_timing(response.headers.get('Server-Timing', '')).items():
+            stages[stage].append(duration)
+
+
+async def run(args) -> dict:
+    os.environ['OPENAI_API_BASE'] = f'http://127.0.0.1:{args.open_ai_port}/v1'
+    os.environ['OPENAI_API_KEY'] = 'sk-benchmark'
+    os.environ['DUCKLING_URL'] = f'http://127.0.0.1:{args.duckling_port}/parse'
+
+    # the server has to be imported after the environment variables pointing to the stand-ins are set
+    import aiohttp
+    import uvicorn
+    from server import app, chat_bot
+
+    chat_bot.cache_responses = args.response_cache
+    chat_bot.state_extractor.cache_responses = args.response_cache
+    if args.mode is not None:
+        chat_bot.state_extractor.extraction_mode = args.mode
+
+    fake_open_ai = FakeOpenAi(Latency(args.latency, args.jitter), args.dataset)
+    fake_duckling = FakeDuckling(Latency(args.duckling_latency, args.duckling_latency / 2))
+    runners = [await start_app(fake_open_ai.create_app(), args.open_ai_port),
+               await start_app(fake_duckling.create_app(), args.duckling_port)]
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=args.port, log_level='warning'))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    conversations = load_conversations(args.dataset) * args.repeat
+    latencies = []
+    stages = defaultdict(list)
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def replay(index: int, conversation: dict):
+        async with limit:
+            await replay_conversation(http, url, f'benchmark-{index}', conversation['user_messages'], latencies,
+                                      stages)
+
+    try:
+        url = f'http://127.0.0.1:{args.port}/chat/'
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as http:
+            start = time.perf_counter()
+            await asyncio.gather(*[replay(index, conversation) for index, conversation in enumerate(conversations)])
+            elapsed = time.perf_counter() - start
+    finally:
+        server.should_exit = True
+        await server_task
+        for runner in runners:
+            await runner.cleanup()
+
+    return summarize(latencies) | {
+        'mode': chat_bot.state_extractor.extraction_mode,
+        'throughput': len(latencies) / elapsed,
+        'duration': elapsed,
+        'stages': {stage: summarize(samples) for stage, samples in sorted(stages.items())},
+        'requests': {'open_ai': fake_open_ai.requests, 'duckling': fake_duckling.requests},
+        'fast_path': chat_bot.state_extractor.fast_path_statistics()
+    }
+
+
+def print_results(results: dict):
+    print(f"mode: {results['mode']}, turns: {results['count']}, throughput: {results['throughput']:.1f} turns/s, "
+          f"latency p50: {results['p50'] * 1000:.0f}ms, p95: {results['p95'] * 1000:.0f}ms, "
+          f"p99: {results['p99'] * 1000:.0f}ms")
+    print(f"{'stage':<20}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}")
+    for stage, summary in results['stages'].items():
+        print(f"{stage:<20}{summary['count']:>8}{summary['mean'] * 1000:>8.0f}ms{summary['p50'] * 1000:>8.0f}ms"
+              f"{summary['p95'] * 1000:>8.0f}ms")
+    print(f"requests to ChatGPT: {results['requests']['open_ai']}, to duckling: {results['requests']['duckling']}")
+    print(f"states filled by the fast path: {results['fast_path']['hits']} "
+          f"({results['fast_path']['hit_rate']:.0%}), saved about {results['fast_path']['seconds_saved']:.1f}s")
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for metric, higher_is_better in compared_metrics.items():
+        value, expected = results[metric], baseline[metric]
+        if (value < expected * (1 - tolerance)) if higher_is_better else (value > expected * (1 + tolerance)):
+            regressions.append(f"{metric}: {value:.3f} (baseline {expected:.3f})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=10, help='number of conversations replayed at once')
+    parser.add_argument('--repeat', type=int, default=4, help='how often every conversation of the dataset is replayed')
+    parser.add_argument('--latency', type=float, default=0.5, help='mean latency of the ChatGPT stand-in in seconds')
+    parser.add_argument('--jitter', type=float, default=0.1, help='standard deviation of the ChatGPT latency')
+    parser.add_argument('--duckling-latency', type=float, default=0.02, help='mean latency of duckling in seconds')
+    parser.add_argument('--response-cache', action='store_true', help='cache responses of ChatGPT')
+    parser.add_argument('--mode', choices=('function', 'table'),
+                        help='query the state by a function call or as table instead of STATE_EXTRACTION_MODE')
+    parser.add_argument('--dataset', default='training/structured-output.jsonl')
+    parser.add_argument('--baseline', default=default_baseline, help='results to compare with, stored per mode')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='store the results as new baseline of the mode')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative deviation accepted')
+    parser.add_argument('--output', help='write the results as json to this file')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--open-ai-port', type=int, default=8082)
+    parser.add_argument('--duckling-port', type=int, default=8083)
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baselines = json.load(file)
+    if args.update_baseline:
+        baselines[results['mode']] = {metric: results[metric] for metric in compared_metrics}
+        with open(args.baseline, 'w') as file:
+            json.dump(baselines, file, indent=2)
+        print(f"Stored results as baseline of {results['mode']} mode in {args.baseline}")
+    elif results['mode'] in baselines:
+        regressions = find_regressions(results, baselines[results['mode']], args.tolerance)
+        if len(regressions) > 0:
+            print("Regressions compared to the baseline:\n" + '\n'.join(regressions))
+            sys.exit(1)
+        print("No regressions compared to the baseline")
+
+
+if __name__ == "__main__":
+    main()
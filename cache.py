@@ -0,0 +1,52 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+MISSING = object()
+
+
+class TtlLruCache:
+    """A cache with a maximal number of entries and a time to live.
+    If the cache is full, the least recently used entry is evicted."""
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        """Returns the cached value or default if there is no entry or it is expired"""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.__entries[key]
+                self.misses += 1
+                return default
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self.__lock:
+            self.__entries[key] = (time.monotonic() + self.ttl, value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def statistics(self) -> dict:
+        """Returns the number of cache hits, misses, the hit rate and the number of entries"""
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+                'size': len(self)}
@@ -1,9 +1,13 @@
+import asyncio
 import datetime
 import logging
 
 from chat_gpt_adapter import ChatGptAdapter
 from control_flow_manager import ControlFlowManager
+import metrics
+from history_manager import HistoryManager
 from price_calculator import calculate_price
+from slot_schema import create_information_list, create_summary_rows
 from state import State
 from state_extractor import StateExtractor
 
@@ -27,6 +31,11 @@ class ChatBot:
     control_flow_manager = ControlFlowManager()
     chat_gpt_adapter = ChatGptAdapter()
     state_extractor = StateExtractor()
+    history_manager = HistoryManager()
+    # generate the response in parallel to the state extraction, based on the state of the previous turn
+    pipelined = True
+    # reuse responses of ChatGPT for the same chat history, e.g. for frequently asked questions
+    cache_responses = True
 
     def continue_chat(
             self,
@@ -36,30 +45,185 @@ class ChatBot:
         logging.info(f"Enter continue_chat")
 
         state = self.state_extractor.query_state(messages, self.chat_gpt_adapter)
+        missing_information = self.__find_missing_info(state)
+
+        with metrics.span('reply_completion'):
+            next_response_from_bot = self.chat_gpt_adapter.chat_completion(
+                self.__create_reply_prompt(messages, state, missing_information), 0.25,
+                self.chat_gpt_adapter.booking_model, self.cache_responses)
+
+        return self.__create_response(state, missing_information, next_response_from_bot)
+
+    async def continue_chat_async(
+            self,
+            messages: list,
+            previous_state: State | None = None
+    ) -> dict:
+        """Same as continue_chat, but does not block the event loop while waiting for ChatGPT and duckling.
+        The returned dictionary additionally contains the state extracted from the chat history.
+        If the state of the previous turn is given, the response is generated while the new state is extracted."""
+        logging.info(f"Enter continue_chat_async")
+        if self.pipelined and previous_state is not None:
+            return await self.__continue_chat_pipelined(messages, previous_state)
+
+        state = await self.state_extractor.query_state_async(
+            messages, self.chat_gpt_adapter, previous_state, self.__find_missing_attribute(previous_state))
+        missing_information = self.__find_missing_info(state)
+
+        next_response_from_bot = await self.__complete_reply_async(
+            self.__create_reply_prompt(messages, state, missing_information))
+
+        return self.__create_response(state, missing_information, next_response_from_bot) | {'state': state}
+
+    async def __continue_chat_pipelined(self, messages: list, previous_state: State) -> dict:
+        """Starts generating the response based on the previous state right away.
+        The response is only generated again if the new state changes the instructions given to ChatGPT."""
+        previous_missing_information = self.__find_missing_info(previous_state)
+        speculative_response = asyncio.ensure_future(self.__complete_reply_async(
+            self.__create_reply_prompt(messages, previous_state, previous_missing_information)))
+        try:
+            state = await self.state_extractor.query_state_async(
+                messages, self.chat_gpt_adapter, previous_state, self.__find_missing_attribute(previous_state))
+            missing_information = self.__find_missing_info(state)
+
+            chat_control_msg = self.control_flow_manager.handle_state(state, missing_information)
+            if chat_control_msg.msg_to_user is not None:
+                speculative_response.cancel()
+                return {'text': chat_control_msg.msg_to_user, 'flag': chat_control_msg.flag, 'state': state}
+
+            if not self.__instructions_changed(state, missing_information, previous_state,
+                                              previous_missing_information):
+                next_response_from_bot = await speculative_response
+            else:
+                logging.info("The new state changed the instructions. Generating the response again")
+                speculative_response.cancel()
+                next_response_from_bot = await self.__complete_reply_async(
+                    self.__create_reply_prompt(messages, state, missing_information))
+        except BaseException:
+            speculative_response.cancel()
+            raise
+        return {'text': next_response_from_bot, 'flag': None, 'state': state}
+
+    async def __complete_reply_async(self, messages: list) -> str:
+        with metrics.span('reply_completion'):
+            return await self.chat_gpt_adapter.chat_completion_async(
+                messages, 0.25, self.chat_gpt_adapter.booking_model, self.cache_responses)
+
+    async def stream_chat_async(
+            self,
+            messages: list,
+            previous_state: State | None = None
+    ):
+        """Same as continue_chat_async, but yields the response in parts as soon as ChatGPT generates them.
+        Every part is yielded as a dictionary with the key 'delta'. The last dictionary yielded contains the
+        complete response like continue_chat_async. Because control flow messages take precedence,
+        parts are only yielded after the new state has been validated."""
+        logging.info(f"Enter stream_chat_async")
+        streaming_task = None
+        try:
+            if self.pipelined and previous_state is not None:
+                previous_missing_information = self.__find_missing_info(previous_state)
+                streaming_task, parts = self.__start_streaming(
+                    self.__create_reply_prompt(messages, previous_state, previous_missing_information))
+
+            state = await self.state_extractor.query_state_async(
+                messages, self.chat_gpt_adapter, previous_state, self.__find_missing_attribute(previous_state))
+            missing_information = self.__find_missing_info(state)
+
+            chat_control_msg = self.control_flow_manager.handle_state(state, missing_information)
+            if chat_control_msg.msg_to_user is not None:
+                yield {'text': chat_control_msg.msg_to_user, 'flag': chat_control_msg.flag, 'state': state}
+                return
+
+            if streaming_task is not None and self.__instructions_changed(state, missing_information, previous_state,
+                                                                          previous_missing_information):
+                logging.info("The new state changed the instructions. Generating the response again")
+                streaming_task.cancel()
+                streaming_task = None
+            if streaming_task is None:
+                streaming_task, parts = self.__start_streaming(
+                    self.__create_reply_prompt(messages, state, missing_information))
+
+            next_response_from_bot = ''
+            while (part := await parts.get()) is not None:
+                next_response_from_bot += part
+                yield {'delta': part}
+            yield {'text': next_response_from_bot, 'flag': None, 'state': state}
+        finally:
+            if streaming_task is not None:
+                streaming_task.cancel()
+
+    def __start_streaming(self, messages: list) -> tuple[asyncio.Task, asyncio.Queue]:
+        """Starts generating the response in the background. The parts are put into the returned queue,
+        the end of the response is marked by None."""
+        parts = asyncio.Queue()
+
+        async def stream():
+            try:
+                with metrics.span('reply_completion'):
+                    async for part in self.chat_gpt_adapter.chat_completion_stream_async(
+                            messages, 0.25, self.chat_gpt_adapter.booking_model, self.cache_responses):
+                        parts.put_nowait(part)
+            finally:
+                parts.put_nowait(None)
 
-        system_text = f"""{self.__create_instruction_prompt(state)}
+        return asyncio.ensure_future(stream()), parts
+
+    async def warm_up(self):
+        """Opens the pooled connections to ChatGPT and duckling before the first message arrives"""
+        await asyncio.gather(self.chat_gpt_adapter.warm_up(), self.state_extractor.duckling_adapter.warm_up())
+
+    async def close(self):
+        """Releases the pooled connections to ChatGPT and duckling"""
+        await self.chat_gpt_adapter.close()
+        await self.state_extractor.duckling_adapter.close()
+
+    def __create_reply_prompt(self, messages: list, state: State, missing_information: str | None) -> list:
+        """Creates the input for the completion generating the next response to the user"""
+        instruction_prompt, additional_instruction = self.__create_instructions(state, missing_information)
+        system_text = f"""{instruction_prompt}
             This is some context information about the hotel: 
             {hotel_information}
-            The current date and time is {datetime.datetime.now()}."""
+            The current date and time is about {datetime.datetime.now():%Y-%m-%d %H:00}."""
         msg_temp = [
                        {"role": "system", "content": system_text},
                        {"role": "assistant",
                         "content": f"Hi there! Would you like to book a hotel room? When do you arrive?"},
-                   ] + messages
+                   ] + self.history_manager.compact(messages, state)
 
-        missing_information = self.__find_missing_info(state)
-        if missing_information is not None:
-            msg = f"Do not show the booking summary yet, because there is missing information, for instance '{missing_information}'."
-            price = calculate_price(state)
-            if price is not None:
-                msg += f" The total price for booking is {price}. If the user asks for the price you can display this value."
+        if additional_instruction is not None:
             msg_temp += [{"role": "system",
-                          "content": msg}]
-            logging.debug("Additional instruction: " + msg)
+                          "content": additional_instruction}]
+            logging.debug("Additional instruction: %s", additional_instruction)
+        return msg_temp
 
-        next_response_from_bot = self.chat_gpt_adapter.chat_completion(msg_temp, 0.25,
-                                                                       self.chat_gpt_adapter.booking_model)
+    def __create_instructions(self, state: State, missing_information: str | None) -> tuple[str, str | None]:
+        """Returns the instructions depending on the state: the instruction prompt containing the booking summary
+        template and an additional instruction if there is missing information"""
+        return self.__create_instruction_prompt(state), self.__create_missing_info_instruction(state, missing_information)
 
+    @staticmethod
+    def __create_missing_info_instruction(state: State, missing_information: str | None) -> str | None:
+        if missing_information is None:
+            return None
+        msg = f"Do not show the booking summary yet, because there is missing information, for instance '{missing_information}'."
+        price = calculate_price(state)
+        if price is not None:
+            msg += f" The total price for booking is {price}. If the user asks for the price you can display this value."
+        return msg
+
+    def __instructions_changed(self, state: State, missing_information: str | None, previous_state: State,
+                               previous_missing_information: str | None) -> bool:
+        """While information is missing, ChatGPT is told not to show the booking summary, so only the missing field
+        and the price matter. The summary template is only compared once all fields are known."""
+        if missing_information is not None and previous_missing_information is not None:
+            return self.__create_missing_info_instruction(state, missing_information) != \
+                self.__create_missing_info_instruction(previous_state, previous_missing_information)
+        return self.__create_instructions(state, missing_information) != \
+            self.__create_instructions(previous_state, previous_missing_information)
+
+    def __create_response(self, state: State, missing_information: str | None, next_response_from_bot: str) -> dict:
+        """Control flow messages, e.g. validation errors, take precedence over the response of ChatGPT"""
         chat_control_msg = self.control_flow_manager.handle_state(state, missing_information)
 
         if chat_control_msg.msg_to_user is not None:
@@ -68,21 +232,25 @@ class ChatBot:
 
     def __find_missing_info(self, state: State) -> str:
         """Returns the label of any missing mandatory field"""
-        missing = list(filter(lambda entry: entry.value is None and entry.mandatory,
-                              state.__dict__.values()))
-        return missing[0].label if len(missing) > 0 else None
+        attribute = self.__find_missing_attribute(state)
+        return getattr(state, attribute).label if attribute is not None else None
+
+    @staticmethod
+    def __find_missing_attribute(state: State | None) -> str | None:
+        """Returns the attribute of the missing mandatory field the bot asks for next"""
+        missing = [attribute for attribute, entry in (state or State()).items()
+                   if entry.value is None and entry.mandatory]
+        return missing[0] if len(missing) > 0 else None
 
     def __create_instruction_prompt(self, state: State):
         return f"""You are a hotel booking assistant. 
         Gather all information required from the user to make the booking. 
-        You need to gather the following information: date of arrival, duration of stay, number of guests, 
-        if they want to have breakfast included, the name of the main guest and the email address of the main guest. 
+        You need to gather the following information: {create_information_list('and')}. 
         Don't be picky regarding date formats. If you don't know the answer to a user's question say: "I don\'t know".
 
         At the end of the booking process you must show a booking summary.
         You must only show the booking summary after gathering all mandatory information. 
-        If you don't know the date of arrival, duration of stay, number of guests, whether breakfast should be included,
-        the name of the guest or the email address, do not show a booking summary!
+        If you don't know the {create_information_list('or')}, do not show a booking summary!
         Use this template when showing the booking summary to the user:
         {self.__create_booking_summary_msg(state)}
 
@@ -98,12 +266,7 @@ class ChatBot:
         summary = f"""<template>
         ~ Booking summary ~ 
 
-        Date of arrival: {state.date_of_arrival.raw_value}
-        Duration of stay: {state.duration_of_stay.raw_value}
-        Number of guests: {state.number_of_guests.raw_value}
-        Name of main guest: {state.name_of_main_guest.raw_value}
-        Breakfast included?: {state.breakfast_included.raw_value}
-        Email address: {state.email_address.raw_value}
+        {create_summary_rows(state, ' ' * 8)}
 
         Price: {price_description}
 
@@ -113,5 +276,5 @@ class ChatBot:
         {"Do you wish to confirm the booking?" if missing_information is None else ''}
         </template>
         """
-        logging.debug("Booking summary template: " + summary)
+        logging.debug("Booking summary template: %s", summary)
         return summary
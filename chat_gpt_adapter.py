@@ -1,48 +1,331 @@
+import asyncio
 import concurrent.futures
+import json
 import logging
+import os
+import time
 from functools import partial
 
+import aiohttp
 import backoff
 import openai
 
+import metrics
+from response_cache import ResponseCache
+
 
 class ChatGptAdapter:
     """Implements an adapter to the ChatGPT API"""
 
     booking_model = "gpt-3.5-turbo-0613"
     structured_query_model = "ft:gpt-3.5-turbo-0613:personal::87fl6OLL"
+    # the 0613 models can be forced to answer with the arguments of a function call
+    function_calling_model = "gpt-3.5-turbo-0613"
+    pool_size = 100
+    timeout = 5
+    # seconds a streamed response may pause between two parts before it is aborted
+    stream_idle_timeout = 10
+    # all blocking API calls share a bounded pool of threads
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=32, thread_name_prefix='chat_gpt_adapter')
+    # if a request takes longer than this percentile of the latencies observed, a duplicate request is sent
+    # and the response which arrives first is used
+    hedging = os.environ.get('CHAT_GPT_HEDGING', '0') == '1'
+    hedging_percentile = 0.95
+    hedging_min_observations = 20
+    # returned instead of the response if ChatGPT could not be reached
+    error_message = "Sorry. There was an issue transmitting the message. Could you repeat please?"
+
+    def __init__(self):
+        self.__async_session = None
+        # the same questions are asked again and again, e.g. the first message of every session is the same
+        self.response_cache = ResponseCache(path=os.environ.get('RESPONSE_CACHE_PATH'))
 
-    def chat_completion(self, messages, temperature=0.5, model='gpt-3.5-turbo-0613') -> str:
+    def chat_completion(self, messages, temperature=0.5, model='gpt-3.5-turbo-0613', use_cache=True) -> str:
         """ calls the ChatGPT API with the messages given as parameters as input """
+        response = self.__complete('chat_completion', messages, temperature, model, use_cache)
+        return response if response is not None else self.error_message
+
+    async def chat_completion_async(self, messages, temperature=0.5, model='gpt-3.5-turbo-0613',
+                                    use_cache=True) -> str:
+        """ same as chat_completion, but does not block the event loop while waiting for the response """
+        response = await self.__complete_async('chat_completion_async', messages, temperature, model, use_cache)
+        return response if response is not None else self.error_message
+
+    def function_call(self, messages, function: dict, temperature=0.2, model='gpt-3.5-turbo-0613',
+                      use_cache=True) -> dict | None:
+        """ calls the ChatGPT API, forcing it to call the function given as json schema, and returns the arguments.
+        None is returned if there was an error or the arguments are no valid json """
+        return self.__complete('function_call', messages, temperature, model, use_cache, function)
+
+    async def function_call_async(self, messages, function: dict, temperature=0.2, model='gpt-3.5-turbo-0613',
+                                  use_cache=True) -> dict | None:
+        """ same as function_call, but does not block the event loop while waiting for the response """
+        return await self.__complete_async('function_call_async', messages, temperature, model, use_cache, function)
+
+    def __complete(self, name, messages, temperature, model, use_cache, function=None):
+        """Looks up the response in the cache, asks ChatGPT otherwise and counts the outcome.
+        Returns the content of the response or the arguments of the function call, None if there was an error."""
         try:
-            logging.info('enter chat_completion')
-            return self.__chat_completion_with_timeout(messages, temperature, model)
+            logging.info(f'enter {name}')
+            key = self.response_cache.create_key(model, messages, temperature, function) if use_cache else None
+            response = self.response_cache.get(key) if use_cache else None
+            if response is not None:
+                metrics.chat_gpt_requests.inc(model, 'cached')
+                return self.__create_result(response, function)
+            response = self.__chat_completion_with_timeout(messages, temperature, model, function)
+            result = self.__create_result(response, function)
+            if use_cache:
+                self.response_cache.put(key, response)
+            metrics.chat_gpt_requests.inc(model, 'success')
+            return result
         except Exception as e:
-            logging.error(e)
-            logging.info('exit chat_completion with error')
-            return "Sorry. There was an issue transmitting the message. Could you repeat please?"
+            self.__count_error(name, model, e)
+            return None
 
+    async def __complete_async(self, name, messages, temperature, model, use_cache, function=None):
+        """Same as __complete for the async entry points"""
+        try:
+            logging.info(f'enter {name}')
+            key = self.response_cache.create_key(model, messages, temperature, function) if use_cache else None
+            response = await self.response_cache.get_async(key) if use_cache else None
+            if response is not None:
+                metrics.chat_gpt_requests.inc(model, 'cached')
+                return self.__create_result(response, function)
+            response = await self.__chat_completion_with_timeout_async(messages, temperature, model, function)
+            result = self.__create_result(response, function)
+            if use_cache:
+                await self.response_cache.put_async(key, response)
+            metrics.chat_gpt_requests.inc(model, 'success')
+            return result
+        except Exception as e:
+            self.__count_error(name, model, e)
+            return None
 
-    def __try_chat_completion(self, messages, temperature, model) -> str:
+    @staticmethod
+    def __count_error(name, model, e):
+        metrics.chat_gpt_requests.inc(model, 'error')
+        # a timeout has no message
+        logging.error(str(e) or type(e).__name__)
+        logging.info(f'exit {name} with error')
+
+    async def chat_completion_stream_async(self, messages, temperature=0.5, model='gpt-3.5-turbo-0613',
+                                           use_cache=True):
+        """ same as chat_completion_async, but yields the response in parts as soon as they are generated """
+        has_yielded = False
+        try:
+            logging.info('enter chat_completion_stream_async')
+            key = self.response_cache.create_key(model, messages, temperature) if use_cache else None
+            response = await self.response_cache.get_async(key) if use_cache else None
+            if response is not None:
+                metrics.chat_gpt_requests.inc(model, 'cached')
+                yield response
+                return
+            self.__configure_api_key()
+            openai.aiosession.set(self.__get_async_session())
+            # the timeout only applies until the response starts, afterwards each part has to arrive within
+            # stream_idle_timeout, so a stalled stream does not keep the turn running until openai gives up
+            chunks = await asyncio.wait_for(openai.ChatCompletion.acreate(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                stream=True
+            ), timeout=self.timeout)
+            response = ''
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(anext(chunks), timeout=self.stream_idle_timeout)
+                except StopAsyncIteration:
+                    break
+                content = chunk["choices"][0]["delta"].get("content")
+                if content:
+                    has_yielded = True
+                    response += content
+                    yield content
+            if use_cache:
+                await self.response_cache.put_async(key, response)
+            metrics.chat_gpt_requests.inc(model, 'success')
+            logging.info('exit chat_completion_stream_async')
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                metrics.chat_gpt_timeouts.inc(model)
+            self.__count_error('chat_completion_stream_async', model, e)
+            if not has_yielded:
+                yield self.error_message
+            else:
+                # the truncated response is not cached, but it is stored in the chat history, so it is marked
+                yield " ... Sorry, my answer was interrupted. Could you repeat your message please?"
+
+    async def warm_up(self, connections: int = 4):
+        """Opens pooled connections to the API, so the first requests do not wait for the TLS handshake.
+        The requests are not authenticated, their response does not matter."""
+
+        async def probe():
+            async with self.__get_async_session().get(f"{openai.api_base}/models") as r:
+                await r.read()
+
+        results = await asyncio.gather(*[probe() for _ in range(connections)], return_exceptions=True)
+        failures = [result for result in results if isinstance(result, Exception)]
+        if len(failures) > 0:
+            logging.warning(f"Warming up the connections to ChatGPT failed: {failures[0]}")
+
+    async def close(self):
+        """Closes the pooled connections used by the async API calls"""
+        if self.__async_session is not None:
+            await self.__async_session.close()
+            self.__async_session = None
+
+    @staticmethod
+    def __configure_api_key():
         # openAI expects to find a file openapi.key in the root folder of the project containing the API key
-        openai.api_key_path = './openapi.key'
+        # unless the key is given by the environment variable OPENAI_API_KEY
+        if openai.api_key is None:
+            openai.api_key_path = './openapi.key'
+
+    def __try_chat_completion(self, messages, temperature, model, function=None) -> str:
+        self.__configure_api_key()
 
+        start = time.perf_counter()
+        # the request timeout ensures that the thread is released even if chatGPT hangs
         response = openai.ChatCompletion.create(
             model=model,
             messages=messages,
-            temperature=temperature
+            temperature=temperature,
+            request_timeout=self.timeout,
+            **self.__create_function_options(function)
         )
-        response_message = response["choices"][0]["message"]
+        self.__record_response(model, response, time.perf_counter() - start)
         logging.info('exit chat_completion')
-        return response_message.content
+        return self.__read_message(response, function)
+
+    async def __try_chat_completion_async(self, messages, temperature, model, function=None) -> str:
+        self.__configure_api_key()
+        # openai picks up the session from a context variable, so every request reuses the pooled connections
+        openai.aiosession.set(self.__get_async_session())
+
+        start = time.perf_counter()
+        response = await openai.ChatCompletion.acreate(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            **self.__create_function_options(function)
+        )
+        self.__record_response(model, response, time.perf_counter() - start)
+        logging.info('exit chat_completion_async')
+        return self.__read_message(response, function)
+
+    @staticmethod
+    def __create_function_options(function) -> dict:
+        if function is None:
+            return {}
+        return {'functions': [function], 'function_call': {'name': function['name']}}
+
+    @staticmethod
+    def __read_message(response, function) -> str:
+        """Returns the content of the message or, if a function is called, the arguments as json"""
+        response_message = response["choices"][0]["message"]
+        if function is None:
+            return response_message.content
+        function_call = response_message.get("function_call")
+        if function_call is None:
+            raise ValueError(f"{function['name']} was not called")
+        return function_call["arguments"]
+
+    @staticmethod
+    def __create_result(response: str, function):
+        return ChatGptAdapter.__parse_arguments(response) if function is not None else response
+
+    @staticmethod
+    def __parse_arguments(arguments: str) -> dict:
+        parsed_arguments = json.loads(arguments)
+        if not isinstance(parsed_arguments, dict):
+            raise ValueError(f"the arguments of the function call are no object: {arguments}")
+        return parsed_arguments
+
+    @staticmethod
+    def __record_response(model, response, latency):
+        metrics.chat_gpt_request_duration.labels(model).observe(latency)
+        usage = response.get("usage")
+        if usage is not None:
+            metrics.chat_gpt_tokens.inc(model, 'prompt', amount=usage["prompt_tokens"])
+            metrics.chat_gpt_tokens.inc(model, 'completion', amount=usage["completion_tokens"])
+
+    def __get_async_session(self) -> aiohttp.ClientSession:
+        # the session has to be created lazily because it binds to the running event loop
+        if self.__async_session is None or self.__async_session.closed:
+            self.__async_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=30))
+        return self.__async_session
+
+    def __hedging_delay(self, model) -> float | None:
+        """Returns the time after which a duplicate request is sent or None if no request should be sent"""
+        histogram = metrics.chat_gpt_request_duration.labels(model)
+        if not self.hedging or histogram.count < self.hedging_min_observations:
+            return None
+        delay = histogram.percentile(self.hedging_percentile)
+        return delay if delay < self.timeout else None
 
     @backoff.on_exception(backoff.expo,
                           Exception,
-                          max_tries=2)
-    def __chat_completion_with_timeout(self, messages, temperature, model) -> str:
+                          max_tries=2,
+                          on_backoff=lambda details: metrics.chat_gpt_retries.inc(details['args'][3]))
+    def __chat_completion_with_timeout(self, messages, temperature, model, function=None) -> str:
         """ Sadly, chatGPT 'hangs' sometimes and there is no response for many minutes
-        As a workaround for this issue a request is aborted after some seconds and a retry performed.s
+        As a workaround for this issue a request is aborted after some seconds and a retry performed.
         """
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future = executor.submit(partial(self.__try_chat_completion, messages, temperature, model))
-            return future.result(timeout=5)
+        deadline = time.monotonic() + self.timeout
+        requests = {self.executor.submit(partial(self.__try_chat_completion, messages, temperature, model, function))}
+        try:
+            delay = self.__hedging_delay(model)
+            if delay is not None:
+                done, _ = concurrent.futures.wait(requests, timeout=delay)
+                if len(done) == 0:
+                    logging.info(f'sending a hedged request to {model}')
+                    metrics.chat_gpt_hedged_requests.inc(model)
+                    requests.add(self.executor.submit(
+                        partial(self.__try_chat_completion, messages, temperature, model, function)))
+            while True:
+                done, requests = concurrent.futures.wait(requests, timeout=max(deadline - time.monotonic(), 0),
+                                                         return_when=concurrent.futures.FIRST_COMPLETED)
+                if len(done) == 0:
+                    metrics.chat_gpt_timeouts.inc(model)
+                    raise TimeoutError(f'no response from {model} within {self.timeout} seconds')
+                successful = [future for future in done if future.exception() is None]
+                if len(successful) > 0 or len(requests) == 0:
+                    return (successful or list(done))[0].result()
+        finally:
+            # requests still running are not waited for, they end at the latest after the request timeout
+            for future in requests:
+                future.cancel()
+
+    @backoff.on_exception(backoff.expo,
+                          Exception,
+                          max_tries=2,
+                          on_backoff=lambda details: metrics.chat_gpt_retries.inc(details['args'][3]))
+    async def __chat_completion_with_timeout_async(self, messages, temperature, model, function=None) -> str:
+        """ Same workaround as __chat_completion_with_timeout. Here the hanging request is actually cancelled. """
+        try:
+            return await asyncio.wait_for(self.__hedged_chat_completion_async(messages, temperature, model, function),
+                                          timeout=self.timeout)
+        except asyncio.TimeoutError:
+            metrics.chat_gpt_timeouts.inc(model)
+            raise
+
+    async def __hedged_chat_completion_async(self, messages, temperature, model, function=None) -> str:
+        requests = {asyncio.ensure_future(self.__try_chat_completion_async(messages, temperature, model, function))}
+        try:
+            delay = self.__hedging_delay(model)
+            if delay is not None:
+                done, _ = await asyncio.wait(requests, timeout=delay)
+                if len(done) == 0:
+                    logging.info(f'sending a hedged request to {model}')
+                    metrics.chat_gpt_hedged_requests.inc(model)
+                    requests.add(asyncio.ensure_future(
+                        self.__try_chat_completion_async(messages, temperature, model, function)))
+            while True:
+                done, requests = await asyncio.wait(requests, return_when=asyncio.FIRST_COMPLETED)
+                successful = [task for task in done if task.exception() is None]
+                if len(successful) > 0 or len(requests) == 0:
+                    return (successful or list(done))[0].result()
+        finally:
+            for task in requests:
+                task.cancel()
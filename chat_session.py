@@ -0,0 +1,44 @@
+from state import State
+
+
+class ChatSession:
+    """Holds the chat history and the most recently extracted state of the conversation with a guest"""
+
+    # replies remembered for retried messages, by the idempotency key of the message
+    max_replies = 10
+
+    def __init__(self):
+        self.messages = []
+        self.state: State | None = None
+        self.replies = {}
+
+    def size_in_bytes(self) -> int:
+        """Approximates the memory held by the session by the length of the messages"""
+        return sum(len(message['content']) for message in self.messages)
+
+    def remember_reply(self, idempotency_key: str, reply: dict):
+        self.replies[idempotency_key] = reply
+        # dictionaries keep the insertion order, the oldest reply is forgotten first
+        while len(self.replies) > self.max_replies:
+            del self.replies[next(iter(self.replies))]
+
+    def copy(self) -> 'ChatSession':
+        """Returns a copy whose messages and replies can be changed without changing this session.
+        The messages and the state are not changed once added, so they are shared."""
+        session = ChatSession()
+        session.messages = list(self.messages)
+        session.state = self.state
+        session.replies = dict(self.replies)
+        return session
+
+    def to_dict(self) -> dict:
+        return {'messages': self.messages, 'state': self.state.to_dict() if self.state is not None else None,
+                'replies': self.replies}
+
+    @staticmethod
+    def from_dict(values: dict) -> 'ChatSession':
+        session = ChatSession()
+        session.messages = values['messages']
+        session.state = State.from_dict(values['state']) if values['state'] is not None else None
+        session.replies = values.get('replies', {})
+        return session
@@ -1,5 +1,6 @@
 import logging
 
+import metrics
 from booking_information_validator import BookingInformationValidator
 from state import State
 
@@ -24,7 +25,10 @@ class ControlFlowManager:
         """Performs validation and analyses the chat state. It returns a dictionary
         that can contain a chat message to the user."""
         logging.info(f"Enter handle_state")
+        with metrics.span('handle_state'):
+            return self.__handle_state(state, missing_information)
 
+    def __handle_state(self, state: State, missing_information: str | None) -> ChatControlMsg:
         validation_result = self.booking_information_validator.validate(state)
         if validation_result['has_error']:
             logging.info(f"Exit handle_state with validator error")
@@ -40,7 +44,7 @@ class ControlFlowManager:
             logging.info("Mock booking performed")
             response.msg_to_user = f"Thank you for choosing our hotel. A booking confirmation was sent to {state.email_address.raw_value}. Have a great day!"
             response.flag = 'booking_finished'
-        logging.info(f"Exit handle_state: {response}")
+        logging.info("Exit handle_state: %s", response)
         return response
 
 
@@ -1,24 +1,149 @@
+import asyncio
 import logging
+import os
+import time
 from typing import Any
+
+import aiohttp
 import requests
 
+import metrics
+from cache import MISSING, TtlLruCache
+
 
 class DucklingAdapter:
-    """This class communicates with the ducking docker container on port 8000 to extract information from text"""
+    """This class communicates with the ducking docker container on port 8000 to extract information from text.
+    Results are cached, because the same values are parsed again and again in every turn of a conversation."""
+
+    url = os.environ.get('DUCKLING_URL', 'http://0.0.0.0:8000/parse')
+    # duckling answers 'quack!' on its root path once it is ready
+    health_url = url.rsplit('/', 1)[0] + '/'
+    pool_size = 100
+    timeout = 5
+    # the reference time of relative dates like 'tomorrow' is truncated to this number of seconds,
+    # so a cached result is only reused as long as the day has not changed in any time zone
+    reference_time_resolution = 15 * 60
+
+    def __init__(self, cache_size: int = 4096, cache_ttl: float = 3600):
+        # keep-alive connections are reused between calls instead of opening a new connection per query
+        self.__session = requests.Session()
+        self.__async_session = None
+        self.cache = TtlLruCache(cache_size, cache_ttl)
+        # concurrent queries of the same value wait for a single request to duckling
+        self.__pending = {}
+
     def query_duckling(
             self,
             text: str,
             dimension: str
     ) -> Any:
+        key, reference_time = self.__create_cache_key(text, dimension)
+        value = self.cache.get(key)
+        if value is not MISSING:
+            return value
+        try:
+            with metrics.span('duckling'):
+                response = self.__session.post(self.url, data=self.__create_payload(text, dimension, reference_time),
+                                               timeout=self.timeout).json()
+            value = self.__extract_value_from_response(response, dimension)
+            self.cache.put(key, value)
+            metrics.duckling_requests.inc(dimension, 'success')
+            return value
+        except Exception as e:
+            metrics.duckling_requests.inc(dimension, 'failure')
+            logging.error(e)
+
+    async def query_duckling_async(
+            self,
+            text: str,
+            dimension: str
+    ) -> Any:
+        """Same as query_duckling, but does not block the event loop while waiting for duckling"""
+        key, reference_time = self.__create_cache_key(text, dimension)
+        value = self.cache.get(key)
+        if value is not MISSING:
+            return value
+        if key not in self.__pending:
+            self.__pending[key] = asyncio.ensure_future(self.__query_and_cache(key, text, dimension, reference_time))
         try:
-            response = requests.post('http://0.0.0.0:8000/parse', data={"text": text, "dims": f'["{dimension}"]' }).json()
-            if len(response) > 0:
-                if 'normalized' in response[0]['value'] and dimension == 'duration':
-                    return response[0]['value']['normalized']['value'] / 24 / 3600
-                if 'value' in response[0]['value']:
-                    return response[0]['value']['value']
-                elif 'values' in response[0]['value']:
-                    return response[0]['value']['values'][0]
-            return None
+            return await asyncio.shield(self.__pending[key])
         except Exception as e:
             logging.error(e)
+
+    def is_healthy(self) -> bool:
+        """Returns whether duckling is running and ready to parse"""
+        try:
+            return self.__session.get(self.health_url, timeout=1).ok
+        except requests.RequestException:
+            return False
+
+    async def warm_up(self, connections: int = 4):
+        """Opens pooled connections to duckling, so the first queries do not wait for connections"""
+
+        async def probe():
+            async with self.__get_async_session().get(self.health_url) as r:
+                await r.read()
+
+        results = await asyncio.gather(*[probe() for _ in range(connections)], return_exceptions=True)
+        failures = [result for result in results if isinstance(result, Exception)]
+        if len(failures) > 0:
+            logging.warning(f"Warming up the connections to duckling failed: {failures[0]}")
+
+    def cache_statistics(self) -> dict:
+        """Returns the hits, misses and the hit rate of the cache"""
+        return self.cache.statistics()
+
+    async def close(self):
+        """Closes the pooled connections of the async client"""
+        if self.__async_session is not None:
+            await self.__async_session.close()
+            self.__async_session = None
+
+    async def __query_and_cache(self, key: tuple, text: str, dimension: str, reference_time: int | None) -> Any:
+        try:
+            with metrics.span('duckling'):
+                async with self.__get_async_session().post(
+                        self.url, data=self.__create_payload(text, dimension, reference_time)) as r:
+                    response = await r.json(content_type=None)
+            value = self.__extract_value_from_response(response, dimension)
+            self.cache.put(key, value)
+            metrics.duckling_requests.inc(dimension, 'success')
+            return value
+        except Exception:
+            metrics.duckling_requests.inc(dimension, 'failure')
+            raise
+        finally:
+            del self.__pending[key]
+
+    def __get_async_session(self) -> aiohttp.ClientSession:
+        # the session has to be created lazily because it binds to the running event loop
+        if self.__async_session is None or self.__async_session.closed:
+            self.__async_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=30),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.__async_session
+
+    def __create_cache_key(self, text: str, dimension: str) -> tuple[tuple, int | None]:
+        """Returns the cache key and the reference time in milliseconds, which is only relevant for times"""
+        if dimension != 'time':
+            return (text, dimension, None), None
+        reference_time = int(time.time()) // self.reference_time_resolution * self.reference_time_resolution
+        return (text, dimension, reference_time), reference_time * 1000
+
+    @staticmethod
+    def __create_payload(text: str, dimension: str, reference_time: int | None) -> dict:
+        payload = {"text": text, "dims": f'["{dimension}"]'}
+        if reference_time is not None:
+            payload["reftime"] = reference_time
+        return payload
+
+    @staticmethod
+    def __extract_value_from_response(response: list, dimension: str) -> Any:
+        if len(response) > 0:
+            if 'normalized' in response[0]['value'] and dimension == 'duration':
+                return response[0]['value']['normalized']['value'] / 24 / 3600
+            if 'value' in response[0]['value']:
+                return response[0]['value']['value']
+            elif 'values' in response[0]['value']:
+                return response[0]['value']['values'][0]
+        return None
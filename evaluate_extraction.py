@@ -0,0 +1,228 @@
+"""Runs the state extraction over a dataset of conversations and reports the accuracy per field and the throughput.
+
+Every line of the dataset is a json object with the messages of a conversation, like training/structured-output.jsonl.
+If the messages end with the state query and the expected table, the state extracted is compared with it,
+otherwise, e.g. for conversations exported from production, only the validation errors are counted.
+Results are appended to a cache file, so an interrupted run continues where it stopped.
+Use --fake to run against the local stand-ins of ChatGPT and duckling instead of the real services."""
+import argparse
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+
+from benchmark.fake_servers import FakeDuckling, FakeOpenAi, Latency, start_app, state_query_marker
+from slot_schema import booking_slots
+
+date_attributes = {slot.attribute for slot in booking_slots if slot.dim == 'time'}
+
+
+def read_conversations(path: str, model: str):
+    """Yields the key, the chat messages and the expected table (or None) of every conversation of the dataset.
+    The key depends on the model, so results of other models are not reused.
+    The dataset is read line by line, so it may be larger than the memory."""
+    with open(path) as file:
+        for line in file:
+            if line.strip() == '':
+                continue
+            messages = json.loads(line)['messages']
+            key = hashlib.sha256(f"{model}\n{line.strip()}".encode()).hexdigest()[:32]
+            query_index = next((index for index, message in enumerate(messages)
+                                if message['role'] == 'user' and message['content'].find(state_query_marker) > -1),
+                               None)
+            if query_index is None:
+                yield key, messages, None
+                continue
+            answers = [message['content'] for message in messages[query_index + 1:] if message['role'] == 'assistant']
+            yield key, messages[:query_index], answers[0] if len(answers) > 0 else None
+
+
+def load_results(path: str | None) -> dict:
+    """Returns the results of a previous run stored in the cache file"""
+    results = {}
+    if path is not None and os.path.exists(path):
+        with open(path) as file:
+            for line in file:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line is incomplete if the previous run was killed while writing it
+                    continue
+                results[result['key']] = result
+    return results
+
+
+def evaluate_conversation(state_extractor, chat_gpt_adapter, validator, key: str, messages: list,
+                          expected_table: str | None) -> dict:
+    start = time.perf_counter()
+    state = state_extractor.query_state(messages, chat_gpt_adapter)
+    duration = time.perf_counter() - start
+    expected = state_extractor.parse_table(expected_table) if expected_table is not None else None
+    return {'key': key,
+            'duration': duration,
+            'extracted': state.to_dict(),
+            'expected': expected.to_dict() if expected is not None else None,
+            'validation_error': validator.validate(state)['error_msg']}
+
+
+def values_match(attribute: str, extracted, expected) -> bool:
+    """Dates are compared by their day, because duckling returns them in its own time zone,
+    function calls and the fast path in the time zone of the server"""
+    if attribute in date_attributes and isinstance(extracted, str) and isinstance(expected, str):
+        return extracted[:10] == expected[:10]
+    return extracted == expected
+
+
+def summarize(results: list, elapsed: float, evaluated: int) -> dict:
+    compared = [result for result in results if result['expected'] is not None]
+    # the values are compared, not the raw values, which are written differently by a function call
+    fields = {}
+    for attribute in (compared[0]['expected'] if len(compared) > 0 else {}):
+        correct = sum(1 for result in compared
+                      if values_match(attribute, result['extracted'][attribute]['value'],
+                                      result['expected'][attribute]['value']))
+        fields[attribute] = {'correct': correct, 'accuracy': correct / len(compared)}
+    durations = [result['duration'] for result in results]
+    return {'conversations': len(results),
+            'compared': len(compared),
+            'exact_matches': sum(1 for result in compared
+                                 if all(values_match(attribute, result['extracted'][attribute]['value'], entry['value'])
+                                        for attribute, entry in result['expected'].items())),
+            'validation_errors': sum(1 for result in results if result['validation_error'] is not None),
+            'fields': fields,
+            'evaluated': evaluated,
+            'duration': elapsed,
+            'throughput': evaluated / elapsed if elapsed > 0 else 0.0,
+            'mean_latency': sum(durations) / len(durations) if len(durations) > 0 else 0.0}
+
+
+def print_report(report: dict):
+    print(f"conversations: {report['conversations']} ({report['evaluated']} evaluated in this run), "
+          f"compared with the expected state: {report['compared']}, "
+          f"exact matches: {report['exact_matches']}, validation errors: {report['validation_errors']}")
+    print(f"{'field':<24}{'correct':>8}{'accuracy':>10}")
+    for attribute, field in report['fields'].items():
+        print(f"{attribute:<24}{field['correct']:>8}{field['accuracy']:>10.1%}")
+    print(f"throughput: {report['throughput']:.1f} conversations/s, "
+          f"mean latency: {report['mean_latency'] * 1000:.0f}ms")
+
+
+def start_fake_servers(args) -> tuple[asyncio.AbstractEventLoop, list]:
+    """Runs the stand-ins of ChatGPT and duckling on an event loop in a background thread"""
+    os.environ['OPENAI_API_BASE'] = f'http://127.0.0.1:{args.open_ai_port}/v1'
+    os.environ['OPENAI_API_KEY'] = 'sk-evaluation'
+    os.environ['DUCKLING_URL'] = f'http://127.0.0.1:{args.duckling_port}/parse'
+    loop = asyncio.new_event_loop()
+    fake_open_ai = FakeOpenAi(Latency(args.latency, args.latency / 5), args.dataset)
+    fake_duckling = FakeDuckling(Latency(args.latency / 20))
+    runners = [loop.run_until_complete(start_app(fake_open_ai.create_app(), args.open_ai_port)),
+               loop.run_until_complete(start_app(fake_duckling.create_app(), args.duckling_port))]
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop, runners
+
+
+def stop_fake_servers(loop: asyncio.AbstractEventLoop, runners: list):
+    for runner in runners:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def run(args) -> dict:
+    # the adapters read the urls of ChatGPT and duckling from the environment when they are imported
+    from booking_information_validator import BookingInformationValidator
+    from chat_gpt_adapter import ChatGptAdapter
+    from state_extractor import StateExtractor
+
+    chat_gpt_adapter = ChatGptAdapter()
+    state_extractor = StateExtractor()
+    state_extractor.cache_responses = False
+    if args.mode is not None:
+        state_extractor.extraction_mode = args.mode
+    if args.model is not None:
+        chat_gpt_adapter.structured_query_model = args.model
+    if args.function_model is not None:
+        chat_gpt_adapter.function_calling_model = args.function_model
+    # the table model answers in function mode if the function call fails
+    model = chat_gpt_adapter.structured_query_model if state_extractor.extraction_mode == 'table' \
+        else f"{chat_gpt_adapter.function_calling_model} {chat_gpt_adapter.structured_query_model}"
+    validator = BookingInformationValidator()
+
+    results = load_results(args.cache)
+    if len(results) > 0:
+        print(f"Continuing with {len(results)} results from {args.cache}")
+    cache_file = open(args.cache, 'a') if args.cache is not None else None
+    if cache_file is not None and cache_file.tell() > 0:
+        # results are appended behind an incomplete last line of an interrupted run
+        cache_file.write('\n')
+    evaluated = 0
+
+    def store(futures):
+        nonlocal evaluated
+        for future in futures:
+            result = future.result()
+            results[result['key']] = result
+            evaluated += 1
+            if cache_file is not None:
+                cache_file.write(json.dumps(result) + '\n')
+                cache_file.flush()
+
+    start = time.perf_counter()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            pending = set()
+            conversations = read_conversations(args.dataset, f"{state_extractor.extraction_mode} {model}")
+            for key, messages, expected_table in conversations:
+                if key in results:
+                    continue
+                # only a few conversations are read ahead of the ones being evaluated
+                if len(pending) >= 2 * args.concurrency:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    store(done)
+                pending.add(executor.submit(evaluate_conversation, state_extractor, chat_gpt_adapter, validator,
+                                            key, messages, expected_table))
+            store(concurrent.futures.wait(pending).done)
+    finally:
+        if cache_file is not None:
+            cache_file.close()
+    return summarize(list(results.values()), time.perf_counter() - start, evaluated)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dataset', default='training/structured-output.jsonl')
+    parser.add_argument('--mode', choices=('function', 'table'),
+                        help='query the state by a function call or as table instead of STATE_EXTRACTION_MODE')
+    parser.add_argument('--model', help='fine-tuned model queried for the state table instead of the default one, '
+                                        'implies --mode table')
+    parser.add_argument('--function-model', help='model called with the booking function instead of the default one')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of conversations evaluated at once')
+    parser.add_argument('--cache', help='file storing the results, an interrupted run is continued from it')
+    parser.add_argument('--output', help='write the report as json to this file')
+    parser.add_argument('--fake', action='store_true', help='use the local stand-ins of ChatGPT and duckling')
+    parser.add_argument('--latency', type=float, default=0.5, help='mean latency of the ChatGPT stand-in in seconds')
+    parser.add_argument('--open-ai-port', type=int, default=8082)
+    parser.add_argument('--duckling-port', type=int, default=8083)
+    args = parser.parse_args()
+    # the model of the table is only queried in table mode
+    if args.model is not None:
+        if args.mode == 'function':
+            parser.error('--model selects the model of the table, use --function-model with --mode function')
+        args.mode = 'table'
+
+    fake_servers = start_fake_servers(args) if args.fake else None
+    try:
+        report = run(args)
+    finally:
+        if fake_servers is not None:
+            stop_fake_servers(*fake_servers)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import datetime
+import re
+
+from slot_schema import booking_slots
+from state import State
+
+number_words = {'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6, 'seven': 7, 'eight': 8, 'nine': 9,
+                'ten': 10, 'eleven': 11, 'twelve': 12}
+duration_units = {'night': 1, 'day': 1, 'week': 7}
+months = {'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6, 'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10,
+          'nov': 11, 'dec': 12}
+yes_answers = {'yes', 'y', 'yeah', 'yep', 'yup', 'sure', 'of course', 'ok', 'okay', 'please', 'yes please',
+               'yes thanks', 'yes thank you', 'correct', 'confirm', 'confirmed', 'i confirm'}
+no_answers = {'no', 'n', 'nope', 'nah', 'na', 'no thanks', 'no thank you', 'not needed', 'without'}
+# words which are no part of a name, e.g. in 'No Idea' or 'Thank You'
+non_name_words = {'no', 'not', 'yes', 'yeah', 'nope', 'sure', 'idea', 'know', "don't", 'dont', 'thank', 'thanks',
+                  'you', 'please', 'sorry', 'okay', 'ok', 'hello', 'hi', 'hey', 'maybe', 'later', 'why', 'what',
+                  'who', 'which', 'secret', 'private', 'anonymous', 'none', 'nothing', 'skip', 'the', 'a', 'an',
+                  'and', 'or', 'is', 'are', 'it', 'this', 'that', 'my', 'your', 'name', 'email', 'booking', 'hotel',
+                  'breakfast', 'room', 'guest', 'guests', 'night', 'nights', 'today', 'tomorrow'}
+
+number_pattern = r'(\d+|' + '|'.join(number_words) + r')'
+month_pattern = r'(' + '|'.join(months) + r')[a-z]*'
+day_pattern = r'(\d{1,2})(?:st|nd|rd|th)?'
+
+# phrases framing an answer, e.g. 'we are 2 guests, thanks', which are removed before parsing
+leading_phrases = re.compile(r"^(?:(?:we are|we will be|there will be|i would like|i'd like|i want|i arrive|"
+                             r"arriving|arrival|my name is|my email is|my email address is|the name is|name is|"
+                             r"i am|i'm|it's|it is|this is|that is|on|the|for|about|just)\b\s*)+", re.IGNORECASE)
+trailing_phrases = re.compile(r"(?:\s*\b(?:please|thanks|thank you))+$", re.IGNORECASE)
+punctuation = re.compile(r"^[\s.,!:;]+|[\s.,!:;]+$")
+
+number_answer = re.compile(rf'^{number_pattern}(?: (?:guests?|people|persons?|adults?|of us))?$')
+duration_answer = re.compile(rf'^(?:{number_pattern}|an?) (night|day|week)s?$')
+email_answer = re.compile(r'^[\w.+-]+@[\w-]+(?:\.[\w-]+)+$')
+name_answer = re.compile(r"^[A-ZÀ-Ý][a-zà-ÿ'-]+(?: [A-ZÀ-Ý][a-zà-ÿ'-]+){1,3}$")
+iso_date_answer = re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})$')
+dotted_date_answer = re.compile(r'^(\d{1,2})\.(\d{1,2})\.?(\d{4})?$')
+day_month_answer = re.compile(rf'^{day_pattern}(?: of)? {month_pattern}(?:,? (\d{{4}}))?$')
+month_day_answer = re.compile(rf'^{month_pattern} {day_pattern}(?:,? (\d{{4}}))?$')
+question_pattern = re.compile(r'[^.!?\n]*\?')
+
+
+class FastPathExtractor:
+    """Fills the state without asking ChatGPT if the user just answers the question the bot asked,
+    e.g. '2' to 'How many guests will stay?'. The answer is only accepted if the question refers to
+    exactly one field and the whole message is a value of the type of that field.
+    Otherwise None is returned and the state has to be queried from ChatGPT."""
+
+    def extract(self, messages: list, previous_state: State | None, expected_attribute: str | None) -> State | None:
+        """Returns the previous state with the answer of the user filled in or None if the answer is not certain.
+        The expected attribute is the missing field the bot was instructed to ask for."""
+        attribute = self.__find_asked_attribute(messages, previous_state, expected_attribute)
+        if attribute is None:
+            return None
+        state = State.from_dict(previous_state.to_dict()) if previous_state is not None else State()
+        entry = getattr(state, attribute)
+        answer = punctuation.sub('', messages[-1]['content'])
+        value = self.__parse(entry.dim, answer)
+        if value is None:
+            return None
+        # the raw value is shown in the summary and sent to ChatGPT as known value, so it holds the value
+        # without the phrases around it, like the arguments of a function call
+        if entry.dim == 'bool':
+            entry.raw_value = 'Yes' if value else 'No'
+        elif entry.dim in ('number', 'duration'):
+            entry.raw_value = f'{value:g}'
+        elif entry.dim == 'time':
+            entry.raw_value = value[:10]
+        else:
+            entry.raw_value = value
+        entry.value = value
+        return state
+
+    def __find_asked_attribute(self, messages: list, previous_state: State | None,
+                               expected_attribute: str | None) -> str | None:
+        """Returns the field the last question of the bot asks for if it is still unknown"""
+        if len(messages) == 0 or messages[-1]['role'] != 'user':
+            return None
+        if len(messages) == 1:
+            # the greeting of the bot asks for the first missing field, the date of arrival
+            return expected_attribute
+        if messages[-2]['role'] != 'assistant':
+            return None
+        questions = ' '.join(question_pattern.findall(messages[-2]['content'])).lower()
+        asked = [slot.attribute for slot in booking_slots
+                 if any(questions.find(keyword) > -1 for keyword in slot.question_keywords)]
+        if len(asked) != 1:
+            return None
+        # the booking can only be confirmed once all information is known
+        if asked[0] == 'booking_confirmed' and expected_attribute is not None:
+            return None
+        if previous_state is not None and getattr(previous_state, asked[0]).value is not None:
+            return None
+        return asked[0]
+
+    def __parse(self, dim: str, answer: str):
+        match dim:
+            case 'bool':
+                return self.parse_bool(answer)
+            case 'number':
+                return self.parse_number(answer)
+            case 'duration':
+                return self.parse_duration(answer)
+            case 'email':
+                return self.parse_email(answer)
+            case 'time':
+                return self.parse_date(answer)
+            case _:
+                return self.parse_name(answer)
+
+    @staticmethod
+    def __strip_phrases(answer: str, lower: bool = True) -> str:
+        answer = trailing_phrases.sub('', answer.lower() if lower else answer)
+        return punctuation.sub('', leading_phrases.sub('', answer))
+
+    @staticmethod
+    def __to_number(text: str) -> int:
+        return int(text) if text.isdigit() else number_words[text]
+
+    @staticmethod
+    def parse_bool(answer: str) -> bool | None:
+        answer = punctuation.sub('', trailing_phrases.sub('', answer.lower())) or answer.lower()
+        if answer in yes_answers:
+            return True
+        if answer in no_answers:
+            return False
+        return None
+
+    @staticmethod
+    def parse_number(answer: str) -> int | None:
+        match = number_answer.match(FastPathExtractor.__strip_phrases(answer))
+        return FastPathExtractor.__to_number(match.group(1)) if match is not None else None
+
+    @staticmethod
+    def parse_duration(answer: str) -> float | int | None:
+        """Returns the number of nights like duckling: a float for durations, an int for plain numbers"""
+        answer = FastPathExtractor.__strip_phrases(answer)
+        match = duration_answer.match(answer)
+        if match is None:
+            return FastPathExtractor.__to_number(answer) if re.fullmatch(number_pattern, answer) else None
+        count = FastPathExtractor.__to_number(match.group(1)) if match.group(1) is not None else 1
+        return float(count * duration_units[match.group(2)])
+
+    @staticmethod
+    def parse_email(answer: str) -> str | None:
+        """The case of the address is kept"""
+        answer = FastPathExtractor.__strip_phrases(answer, lower=False)
+        return answer if email_answer.match(answer) is not None else None
+
+    @staticmethod
+    def parse_name(answer: str) -> str | None:
+        """Only names written like names are accepted, e.g. 'John Smith' but not 'no idea' or 'No Idea'"""
+        name = leading_phrases.sub('', answer)
+        if name_answer.match(name) is None or name.lower() in yes_answers | no_answers:
+            return None
+        return name if all(word not in non_name_words for word in name.lower().split(' ')) else None
+
+    @staticmethod
+    def parse_date(answer: str, today: datetime.date | None = None) -> str | None:
+        """Returns the date at midnight of the local time zone in the format of duckling, so today is not
+        in the past on servers whose date differs from the date in UTC. Dates without a year lie in the future.
+        Ambiguous formats like 10/11 are left to ChatGPT."""
+        today = today or datetime.date.today()
+        answer = FastPathExtractor.__strip_phrases(answer)
+        year = None
+        if answer == 'today':
+            date = today
+        elif answer == 'tomorrow':
+            date = today + datetime.timedelta(days=1)
+        else:
+            if (match := iso_date_answer.match(answer)) is not None:
+                year, month, day = match.group(1), int(match.group(2)), int(match.group(3))
+            elif (match := dotted_date_answer.match(answer)) is not None:
+                day, month, year = int(match.group(1)), int(match.group(2)), match.group(3)
+            elif (match := day_month_answer.match(answer)) is not None:
+                day, month, year = int(match.group(1)), months[match.group(2)], match.group(3)
+            elif (match := month_day_answer.match(answer)) is not None:
+                month, day, year = months[match.group(1)], int(match.group(2)), match.group(3)
+            else:
+                return None
+            try:
+                date = datetime.date(int(year) if year is not None else today.year, month, day)
+                if year is None and date < today:
+                    date = date.replace(year=today.year + 1)
+            except ValueError:
+                return None
+        # the offset of the local time zone on that date, which may differ from today's offset
+        value = datetime.datetime.combine(date, datetime.time()).astimezone()
+        return value.isoformat(timespec='milliseconds')
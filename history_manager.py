@@ -0,0 +1,83 @@
+import logging
+import os
+import re
+import threading
+
+import metrics
+from state import State
+
+# approximates the tokenizer of ChatGPT: words, numbers and punctuation marks are tokens of their own
+token_pattern = re.compile(r"\w+|[^\w\s]")
+
+default_token_budget = int(os.environ.get('HISTORY_TOKEN_BUDGET', 2000))
+
+
+def count_tokens(text: str) -> int:
+    """Estimates the number of tokens of a text without calling the tokenizer of openAI.
+    Long words are usually split into several tokens."""
+    return sum(1 + len(token) // 8 for token in token_pattern.findall(text))
+
+
+def count_message_tokens(messages: list) -> int:
+    # every message adds a few tokens for the role and separators
+    return sum(count_tokens(message['content']) + 4 for message in messages)
+
+
+class HistoryManager:
+    """Keeps the chat history sent to ChatGPT within a token budget.
+    The most recent messages are kept verbatim, older messages are folded into a short summary
+    consisting of the information extracted already and the earlier messages of the user."""
+
+    def __init__(self, token_budget: int = default_token_budget, min_recent_messages: int = 4,
+                 max_user_message_length: int = 200):
+        self.token_budget = token_budget
+        self.min_recent_messages = min_recent_messages
+        self.max_user_message_length = max_user_message_length
+        self.tokens_saved = 0
+        self.compacted_turns = 0
+        self.__lock = threading.Lock()
+
+    def compact(self, messages: list, state: State | None = None) -> list:
+        """Returns the history unchanged if it fits into the token budget, a compacted history otherwise"""
+        tokens = [count_message_tokens([message]) for message in messages]
+        total_tokens = sum(tokens)
+        if total_tokens <= self.token_budget:
+            return messages
+
+        start, recent_tokens = len(messages), 0
+        while start > 0 and (len(messages) - start < self.min_recent_messages or
+                             recent_tokens + tokens[start - 1] <= self.token_budget):
+            start -= 1
+            recent_tokens += tokens[start]
+        if start == 0:
+            return messages
+
+        compacted = [self.__create_summary(messages[:start], state)] + messages[start:]
+        tokens_saved = total_tokens - count_message_tokens(compacted)
+        with self.__lock:
+            self.tokens_saved += tokens_saved
+            self.compacted_turns += 1
+        metrics.prompt_tokens_saved.inc(amount=tokens_saved)
+        logging.info("Compacted %d messages of the chat history, saved %d prompt tokens", start, tokens_saved)
+        return compacted
+
+    def __create_summary(self, older_messages: list, state: State | None) -> dict:
+        summary = "Summary of the earlier conversation."
+        if state is not None:
+            known_values = [f"{entry.label}: {entry.raw_value}" for entry in state.values()
+                            if entry.raw_value is not None]
+            if len(known_values) > 0:
+                summary += " Information provided by the user so far: " + "; ".join(known_values) + "."
+        # the summary must stay small as well, so only the most recent of the earlier user messages are kept
+        user_messages, summary_tokens = [], count_tokens(summary)
+        for message in reversed(older_messages):
+            if message['role'] != 'user':
+                continue
+            content = message['content'][:self.max_user_message_length]
+            summary_tokens += count_tokens(content)
+            if summary_tokens > self.token_budget // 4:
+                break
+            user_messages.insert(0, content)
+        if len(user_messages) > 0:
+            summary += " Earlier messages of the user: " + " / ".join(user_messages)
+        return {"role": "system", "content": summary}
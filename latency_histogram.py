@@ -0,0 +1,31 @@
+import bisect
+import threading
+
+default_buckets = (0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 4, 5, 7.5, 10, 15, 30, float('inf'))
+
+
+class LatencyHistogram:
+    """Counts observed latencies in seconds in buckets, which allows to estimate percentiles cheaply"""
+
+    def __init__(self, buckets: tuple = default_buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.__lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        with self.__lock:
+            self.bucket_counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def percentile(self, percentile: float) -> float:
+        """Returns the upper bound of the bucket containing the given percentile (0..1) of the latencies"""
+        rank = percentile * self.count
+        cumulative_count = 0
+        for bound, bucket_count in zip(self.buckets, self.bucket_counts):
+            cumulative_count += bucket_count
+            if cumulative_count >= rank:
+                return bound
+        return self.buckets[-1]
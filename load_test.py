@@ -0,0 +1,66 @@
+"""Load test showing that concurrent chat sessions are served in parallel by a single server process.
+
+ChatGPT and duckling are replaced by local stand-ins answering after a fixed delay, so neither an
+openAI key nor the duckling docker container is required. Run it with `python load_test.py`."""
+import argparse
+import asyncio
+import os
+import time
+
+from benchmark.fake_servers import FakeDuckling, FakeOpenAi, Latency, start_app
+
+
+async def run_session(http, url: str, session_id: str, turns: int) -> None:
+    for turn in range(turns):
+        message = {'text': f'message {turn} of {session_id}', 'sessionId': session_id}
+        async with http.post(url, json=message) as response:
+            response.raise_for_status()
+            await response.json()
+
+
+async def main(args):
+    os.environ['OPENAI_API_BASE'] = f'http://127.0.0.1:{args.open_ai_port}/v1'
+    os.environ['OPENAI_API_KEY'] = 'sk-load-test'
+    os.environ['DUCKLING_URL'] = f'http://127.0.0.1:{args.duckling_port}/parse'
+
+    # the server has to be imported after the environment variables pointing to the stand-ins are set
+    import aiohttp
+    import uvicorn
+    from server import app
+
+    runners = [await start_app(FakeOpenAi(Latency(args.delay)).create_app(), args.open_ai_port),
+               await start_app(FakeDuckling(Latency(args.delay / 10)).create_app(), args.duckling_port)]
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=args.port, log_level='warning'))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    try:
+        url = f'http://127.0.0.1:{args.port}/chat/'
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as http:
+            start = time.perf_counter()
+            await asyncio.gather(*[run_session(http, url, f'load-test-{i}', args.turns) for i in range(args.sessions)])
+            elapsed = time.perf_counter() - start
+    finally:
+        server.should_exit = True
+        await server_task
+        for runner in runners:
+            await runner.cleanup()
+
+    # every turn waits for two completions, if sessions were served one after another the test would take this long
+    serialized = args.sessions * args.turns * 2 * args.delay
+    print(f"{args.sessions} sessions x {args.turns} turns: {elapsed:.2f}s "
+          f"(serialized at least {serialized:.2f}s, speedup {serialized / elapsed:.1f}x)")
+    if elapsed >= serialized / 2:
+        raise SystemExit("Concurrent sessions were not served in parallel")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sessions', type=int, default=200, help='number of concurrent chat sessions')
+    parser.add_argument('--turns', type=int, default=3, help='number of messages sent per session')
+    parser.add_argument('--delay', type=float, default=0.5, help='response time of the ChatGPT stand-in in seconds')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--open-ai-port', type=int, default=8082)
+    parser.add_argument('--duckling-port', type=int, default=8083)
+    asyncio.run(main(parser.parse_args()))
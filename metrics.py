@@ -0,0 +1,160 @@
+"""Counters, gauges and histograms exposed in the text format of Prometheus.
+
+Set the environment variable METRICS_ENABLED=0 to disable recording, which turns all calls into cheap no-ops."""
+import contextvars
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from latency_histogram import LatencyHistogram
+
+enabled = os.environ.get('METRICS_ENABLED', '1') == '1'
+
+# the trace of the current request: its id and the durations of its stages, None if the request is not traced
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Trace:
+    def __init__(self, trace_id: str | None = None):
+        self.trace_id = trace_id or uuid.uuid4().hex[:16]
+        self.spans = []
+
+    def server_timing(self) -> str:
+        """Returns the durations of the stages in the format of the Server-Timing header"""
+        return ', '.join(f"{stage};dur={duration * 1000:.1f}" for stage, duration in self.spans)
+
+
+class Metric:
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.children = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _format_labels(self, label_values: tuple, extra: str = '') -> str:
+        labels = [f'{name}="{value}"' for name, value in zip(self.label_names, label_values)]
+        if extra:
+            labels.append(extra)
+        return '{' + ','.join(labels) + '}' if labels else ''
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"] + self._render_samples()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *label_values, amount: float = 1):
+        if not enabled:
+            return
+        with self._lock:
+            self.children[label_values] = self.children.get(label_values, 0) + amount
+
+    def _render_samples(self) -> list[str]:
+        return [f"{self.name}{self._format_labels(labels)} {value}" for labels, value in self.children.items()]
+
+
+class Gauge(Metric):
+    """A gauge whose values are read from a function when the metrics are rendered.
+    The function returns a dictionary of label values to values."""
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), function=None):
+        super().__init__(name, documentation, label_names)
+        self.function = function
+
+    def _render_samples(self) -> list[str]:
+        if self.function is None:
+            return []
+        return [f"{self.name}{self._format_labels(labels)} {value}" for labels, value in self.function().items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def labels(self, *label_values) -> LatencyHistogram:
+        """Returns the histogram of the given label values. Observations on it are recorded even if metrics are
+        disabled, e.g. because the latencies of ChatGPT are needed for hedging."""
+        histogram = self.children.get(label_values)
+        if histogram is None:
+            with self._lock:
+                histogram = self.children.setdefault(label_values, LatencyHistogram())
+        return histogram
+
+    def observe(self, value: float, *label_values):
+        if enabled:
+            self.labels(*label_values).observe(value)
+
+    def _render_samples(self) -> list[str]:
+        samples = []
+        for labels, histogram in list(self.children.items()):
+            cumulative_count = 0
+            for bound, bucket_count in zip(histogram.buckets, histogram.bucket_counts):
+                cumulative_count += bucket_count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                samples.append(f"{self.name}_bucket{self._format_labels(labels, le)} {cumulative_count}")
+            samples.append(f"{self.name}_sum{self._format_labels(labels)} {histogram.sum}")
+            samples.append(f"{self.name}_count{self._format_labels(labels)} {histogram.count}")
+        return samples
+
+
+registry: list[Metric] = []
+
+
+def render() -> str:
+    """Returns all metrics in the text format of Prometheus"""
+    lines = []
+    for metric in registry:
+        try:
+            lines += metric.render()
+        except Exception as e:
+            logging.error(f"Error rendering metric {metric.name}: {e}")
+    return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def span(stage: str):
+    """Measures the duration of a stage of a turn"""
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        stage_duration.observe(duration, stage)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.spans.append((stage, duration))
+
+
+stage_duration = Histogram('chatbot_stage_duration_seconds', 'Duration of the stages of a turn', ('stage',))
+chat_gpt_request_duration = Histogram('chatbot_chat_gpt_request_duration_seconds',
+                                      'Latency of successful requests to ChatGPT', ('model',))
+chat_gpt_requests = Counter('chatbot_chat_gpt_requests_total', 'Requests to ChatGPT by outcome', ('model', 'outcome'))
+chat_gpt_timeouts = Counter('chatbot_chat_gpt_timeouts_total', 'Requests to ChatGPT aborted after the timeout',
+                            ('model',))
+chat_gpt_retries = Counter('chatbot_chat_gpt_retries_total', 'Requests to ChatGPT retried', ('model',))
+chat_gpt_hedged_requests = Counter('chatbot_chat_gpt_hedged_requests_total', 'Duplicate requests sent to ChatGPT',
+                                   ('model',))
+chat_gpt_tokens = Counter('chatbot_chat_gpt_tokens_total', 'Tokens processed by ChatGPT', ('model', 'type'))
+duckling_requests = Counter('chatbot_duckling_requests_total', 'Requests to duckling by outcome',
+                            ('dimension', 'outcome'))
+prompt_tokens_saved = Counter('chatbot_prompt_tokens_saved_total', 'Prompt tokens saved by compacting the history')
+fast_path_extractions = Counter('chatbot_fast_path_extractions_total',
+                                'Turns whose state was filled locally (hit) or queried from ChatGPT (fallback)',
+                                ('outcome',))
+fast_path_seconds_saved = Counter('chatbot_fast_path_seconds_saved_total',
+                                  'Estimated latency saved by filling the state locally')
+rejected_turns = Counter('chatbot_rejected_turns_total', 'Turns rejected by the admission control by reason',
+                         ('reason',))
+dropped_log_records = Counter('chatbot_dropped_log_records_total',
+                              'Log records dropped because the writer thread fell behind')
+state_extraction_fallbacks = Counter('chatbot_state_extraction_fallbacks_total',
+                                    'Function calls for the booking information replaced by the table query')
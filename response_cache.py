@@ -0,0 +1,80 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+from cache import TtlLruCache
+
+whitespace_pattern = re.compile(r"\s+")
+
+
+class ResponseCache:
+    """Caches responses of ChatGPT by a hash of the model, the messages and the temperature.
+    Entries are kept in memory and, if a path is given, in a SQLite database so they survive restarts.
+    The async methods access the database in a thread, because a write of another process may lock it."""
+
+    def __init__(self, max_size: int = 4096, ttl: float = 24 * 3600, path: str | None = None):
+        self.ttl = ttl
+        self.memory = TtlLruCache(max_size, ttl)
+        self.disk_hits = 0
+        self.__connection = None
+        self.__lock = threading.Lock()
+        if path is not None:
+            logging.info(f"Using response cache on disk: {path}")
+            self.__connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+            self.__connection.execute('PRAGMA journal_mode=WAL')
+            self.__connection.execute('CREATE TABLE IF NOT EXISTS responses '
+                                      '(key TEXT PRIMARY KEY, response TEXT NOT NULL, expires REAL NOT NULL)')
+            self.__connection.execute('DELETE FROM responses WHERE expires < ?', (time.time(),))
+
+    @staticmethod
+    def create_key(model: str, messages: list, temperature: float, function: dict | None = None) -> str:
+        """Messages which only differ in whitespace have the same key. The function to call is part of the key"""
+        normalized_messages = [(message['role'], whitespace_pattern.sub(' ', message['content']).strip())
+                               for message in messages]
+        key = [model, round(temperature, 3), normalized_messages]
+        if function is not None:
+            key.append(function)
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        response = self.memory.get(key, None)
+        if response is not None or self.__connection is None:
+            return response
+        with self.__lock:
+            row = self.__connection.execute('SELECT response FROM responses WHERE key = ? AND expires >= ?',
+                                            (key, time.time())).fetchone()
+        if row is None:
+            return None
+        self.disk_hits += 1
+        self.memory.put(key, row[0])
+        return row[0]
+
+    async def get_async(self, key: str) -> str | None:
+        response = self.memory.get(key, None)
+        if response is not None or self.__connection is None:
+            return response
+        return await asyncio.to_thread(self.get, key)
+
+    def put(self, key: str, response: str) -> None:
+        self.memory.put(key, response)
+        if self.__connection is not None:
+            self.__write(key, response)
+
+    async def put_async(self, key: str, response: str) -> None:
+        self.memory.put(key, response)
+        if self.__connection is not None:
+            await asyncio.to_thread(self.__write, key, response)
+
+    def __write(self, key: str, response: str):
+        with self.__lock:
+            self.__connection.execute('INSERT OR REPLACE INTO responses (key, response, expires) VALUES (?, ?, ?)',
+                                      (key, response, time.time() + self.ttl))
+
+    def statistics(self) -> dict:
+        """Returns the statistics of the memory cache and the number of entries found on disk"""
+        return self.memory.statistics() | {'disk_hits': self.disk_hits}
@@ -1,17 +1,67 @@
+import argparse
+import asyncio
 import json
 import logging
+import logging.config
+import os
+import time
 
-import docker
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Header
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 
+import metrics
+import structured_logging
+from admission_control import TurnRejected, create_admission_controller
 from chat_bot import ChatBot
+from chat_session import ChatSession
+from session_store import create_session_store
 
 app = FastAPI()
 chat_bot = ChatBot()
 
+# trace every request, otherwise only requests with the header X-Trace-Id are traced
+trace_requests = os.environ.get('TRACE_REQUESTS', '0') == '1'
+
+# set by the launcher, so the workers can report how long it took until they were ready
+launch_time = float(os.environ.get('SERVER_LAUNCH_TIME', time.time()))
+# seconds from the launch until the connections were warmed up, None while the worker is starting
+ready_after = None
+
+
+class TraceMiddleware:
+    """Traces the durations of the stages of a request. The trace id and the durations are returned
+    in the headers X-Trace-Id and Server-Timing of the response."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        trace_id = dict(scope['headers']).get(b'x-trace-id') if scope['type'] == 'http' else None
+        if not metrics.enabled or scope['type'] != 'http' or (trace_id is None and not trace_requests):
+            return await self.app(scope, receive, send)
+
+        trace = metrics.Trace(trace_id.decode('latin-1')[:64] if trace_id is not None else None)
+        token = metrics.current_trace.set(trace)
+
+        async def send_with_trace_headers(message):
+            if message['type'] == 'http.response.start':
+                headers = list(message.get('headers', [])) + [(b'x-trace-id', trace.trace_id.encode('latin-1'))]
+                if len(trace.spans) > 0:
+                    headers.append((b'server-timing', trace.server_timing().encode('latin-1')))
+                message = message | {'headers': headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace_headers)
+        finally:
+            metrics.current_trace.reset(token)
+
+
+app.add_middleware(TraceMiddleware)
+
 
 class Message(BaseModel):
     text: str
@@ -23,29 +73,160 @@ class TextResponse(BaseModel):
     flag: None | str
 
 
-# session_store caches the chat history for each session
-session_store = {}
+# session_store caches the chat history and the last state for each session
+session_store = create_session_store()
+# processes the turns of a session one after another and sheds load if too many turns arrive at once
+admission_controller = create_admission_controller(session_store)
+
+metrics.Gauge('chatbot_active_sessions', 'Sessions held by the session store',
+              function=lambda: {(): session_store.metrics()['active_sessions']})
+metrics.Gauge('chatbot_session_bytes', 'Approximate size of the sessions held by the session store',
+              function=lambda: {(): session_store.metrics()['bytes']})
+metrics.Gauge('chatbot_turns', 'Turns processed or waiting to be processed', ('status',),
+              function=lambda: {('running',): admission_controller.statistics()['running_turns'],
+                                ('waiting',): admission_controller.statistics()['waiting_turns']})
+metrics.Gauge('chatbot_cache_hit_ratio', 'Share of lookups answered by a cache', ('cache',),
+              function=lambda: {('duckling',): chat_bot.state_extractor.duckling_adapter.cache_statistics()['hit_rate'],
+                                ('chat_gpt',): chat_bot.chat_gpt_adapter.response_cache.statistics()['hit_rate']})
+metrics.Gauge('chatbot_cache_entries', 'Entries held by a cache', ('cache',),
+              function=lambda: {('duckling',): chat_bot.state_extractor.duckling_adapter.cache_statistics()['size'],
+                                ('chat_gpt',): chat_bot.chat_gpt_adapter.response_cache.statistics()['size']})
 
 
 @app.post("/chat/", response_model=TextResponse)
-async def send_msg(msg: Message):
-    """Receives messages from the user and sends a text response"""
-    logging.info(f"/chat: {msg.text}")
+async def send_msg(msg: Message, idempotency_key: str | None = Header(default=None)):
+    """Receives messages from the user and sends a text response.
+    A message retried with the same Idempotency-Key header is answered with the reply sent before."""
+    structured_logging.current_session_id.set(msg.sessionId)
+    logging.info("/chat: %s", msg.text)
     if len(msg.text) > 400:
         return {'text': "Your message is too long. Please provide a shorter text", 'flag': None}
 
-    if msg.sessionId not in session_store:
-        session_store[msg.sessionId] = []
-    session_msg = session_store[msg.sessionId]
-    session_msg.append({"role": "user", "content": msg.text})
-
-    response = chat_bot.continue_chat(session_msg)
-    session_msg.append({"role": "assistant", "content": response['text']})
-    logging.debug("Chat history: " + json.dumps(session_msg))
-    logging.info(f"/chat: response: {response}")
+    try:
+        async with admission_controller.admit(msg.sessionId):
+            with metrics.span('turn'):
+                session, previous_reply = await start_turn(msg, idempotency_key)
+                if previous_reply is not None:
+                    logging.info("/chat: answering a retried message with the previous reply")
+                    return previous_reply
+                response = await chat_bot.continue_chat_async(session.messages, session.state)
+                await finish_turn(msg, session, response, idempotency_key)
+    except TurnRejected as e:
+        return rejection_response(e)
+    logging.info("/chat: response: %s", response)
     return response
 
 
+class AdmittedStreamingResponse(StreamingResponse):
+    """Streams the response of an admitted turn and releases the turn once the response ends.
+    The turn is released even if the content is never generated, e.g. because the client disconnected
+    before the response started."""
+
+    def __init__(self, session_id: str, content, **kwargs):
+        super().__init__(content, **kwargs)
+        self.session_id = session_id
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await admission_controller.release(self.session_id)
+
+
+@app.post("/chat/stream/")
+async def stream_msg(msg: Message, idempotency_key: str | None = Header(default=None)):
+    """Receives messages from the user and streams the text response as server-sent events.
+    Every event contains either the next part of the text ('delta') or, as last event, the complete response."""
+    structured_logging.current_session_id.set(msg.sessionId)
+    logging.info("/chat/stream: %s", msg.text)
+    if len(msg.text) > 400:
+        return StreamingResponse(iter([server_sent_event(
+            {'text': "Your message is too long. Please provide a shorter text", 'flag': None})]),
+            media_type="text/event-stream")
+
+    # the turn is admitted before the response starts, so a rejection can still be sent as status code
+    try:
+        await admission_controller.acquire(msg.sessionId)
+    except TurnRejected as e:
+        return rejection_response(e)
+
+    async def generate_events():
+        with metrics.span('turn'):
+            session, previous_reply = await start_turn(msg, idempotency_key)
+            if previous_reply is not None:
+                yield server_sent_event(previous_reply)
+                return
+            async for event in chat_bot.stream_chat_async(session.messages, session.state):
+                if 'delta' not in event:
+                    await finish_turn(msg, session, event, idempotency_key)
+                    logging.info("/chat/stream: response: %s", event)
+                yield server_sent_event(event)
+
+    return AdmittedStreamingResponse(msg.sessionId, generate_events(), media_type="text/event-stream",
+                                     headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def start_turn(msg: Message, idempotency_key: str | None) -> tuple[ChatSession, dict | None]:
+    """Returns the session of the user with the new message appended.
+    If the message was answered already, the session is returned unchanged together with the previous reply."""
+    session = await session_store.get_async(msg.sessionId) or ChatSession()
+    if idempotency_key is not None and idempotency_key in session.replies:
+        return session, session.replies[idempotency_key]
+    session.messages.append({"role": "user", "content": msg.text})
+    return session, None
+
+
+async def finish_turn(msg: Message, session: ChatSession, response: dict, idempotency_key: str | None):
+    """Stores the response of the bot and the new state in the session"""
+    session.state = response.pop('state')
+    session.messages.append({"role": "assistant", "content": response['text']})
+    if idempotency_key is not None:
+        session.remember_reply(idempotency_key, dict(response))
+    await session_store.put_async(msg.sessionId, session)
+    structured_logging.log_history("Chat history", session.messages)
+
+
+def rejection_response(rejection: TurnRejected) -> JSONResponse:
+    return JSONResponse({'text': str(rejection), 'flag': None}, status_code=rejection.status_code,
+                        headers={'Retry-After': str(rejection.retry_after)})
+
+
+def server_sent_event(data: dict) -> str:
+    return f"data: {json.dumps(data)}\n\n"
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Exposes the metrics in the text format of Prometheus. Some gauges query the session store,
+    so the metrics are rendered in a thread."""
+    return PlainTextResponse(await asyncio.to_thread(metrics.render), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/ready")
+async def get_readiness():
+    """Readiness probe: returns 503 until the connections to ChatGPT and duckling are warmed up"""
+    if ready_after is None:
+        return JSONResponse({'ready': False}, status_code=503)
+    return {'ready': True, 'startup_seconds': ready_after}
+
+
+@app.on_event("startup")
+async def warm_up_connections():
+    """Requests are only accepted after the startup, so the first requests find open connections"""
+    global ready_after
+    structured_logging.start_background_logging()
+    start = time.time()
+    await chat_bot.warm_up()
+    ready_after = time.time() - launch_time
+    logging.info(f"Worker {os.getpid()} ready {ready_after:.2f}s after launch, warm-up took {time.time() - start:.2f}s")
+
+
+@app.on_event("shutdown")
+async def close_connections():
+    """Closes the pooled connections to ChatGPT and duckling"""
+    await chat_bot.close()
+
+
 app.mount("/", StaticFiles(directory="static", html=True), name="static")
 
 
@@ -58,16 +239,64 @@ def stop_any_duckling_docker_container(client):
             logging.info("Done.")
 
 
+def start_duckling_docker_container():
+    # docker is only needed if duckling has to be started, importing it takes a while
+    import docker
+
+    client = docker.from_env()
+    stop_any_duckling_docker_container(client)
+    logging.info("Starting duckling docker container on port 8000")
+    return client.containers.run("rasa/duckling", "", ports={8000: 8000}, detach=True)
+
+
+def wait_until_duckling_is_ready(timeout: float):
+    duckling_adapter = chat_bot.state_extractor.duckling_adapter
+    deadline = time.time() + timeout
+    while not duckling_adapter.is_healthy():
+        if time.time() > deadline:
+            raise TimeoutError(f"duckling is not ready after {timeout} seconds")
+        time.sleep(0.25)
+    logging.info(f"Duckling ready {time.time() - launch_time:.2f}s after launch")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Runs the hotel booking chatbot")
+    parser.add_argument('--production', action='store_true',
+                        help='run several workers without reload and reuse a running duckling container')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of workers in production mode')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--duckling-timeout', type=float, default=60,
+                        help='seconds to wait for duckling to become ready in production mode')
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
+    args = parse_arguments()
+    logging.config.fileConfig('./log.ini', disable_existing_loggers=False)
+    os.environ['SERVER_LAUNCH_TIME'] = str(launch_time)
     container = None
     try:
-        client = docker.from_env()
-        stop_any_duckling_docker_container(client)
-        logging.info("Starting duckling docker container on port 8000")
-        container = client.containers.run("rasa/duckling", "", ports={8000: 8000}, detach=True)
-
-        logging.info("Starting server on port 8080.")
-        uvicorn.run("server:app", port=8080, host='0.0.0.0', reload=True, log_config='./log.ini')
+        if not args.production:
+            container = start_duckling_docker_container()
+            logging.info(f"Starting server on port {args.port}.")
+            uvicorn.run("server:app", port=args.port, host=args.host, reload=True, log_config='./log.ini')
+        else:
+            if chat_bot.state_extractor.duckling_adapter.is_healthy():
+                logging.info("Reusing the running duckling")
+            else:
+                container = start_duckling_docker_container()
+            wait_until_duckling_is_ready(args.duckling_timeout)
+            # the workers are separate processes, which only share sessions stored in a database
+            if args.workers > 1 and 'SESSION_STORE' not in os.environ:
+                os.environ['SESSION_STORE'] = 'sqlite:sessions.db'
+                logging.info("Storing the sessions in sessions.db to share them between the workers")
+            elif args.workers > 1 and not os.environ['SESSION_STORE'].startswith('sqlite:'):
+                raise SystemExit("Several workers require a shared session store, "
+                                 "e.g. SESSION_STORE=sqlite:sessions.db")
+            logging.info(f"Starting {args.workers} workers on port {args.port}.")
+            uvicorn.run("server:app", port=args.port, host=args.host, workers=args.workers,
+                        log_config='./log.ini')
     finally:
         if container is not None:
             try:
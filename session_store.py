@@ -0,0 +1,207 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from chat_session import ChatSession
+
+
+class SessionStore(ABC):
+    """Stores the chat session of each user. A session is discarded if it was not used for ttl seconds."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+
+    @abstractmethod
+    def get(self, session_id: str) -> ChatSession | None:
+        """Returns a copy of the session or None if there is no session with the given id.
+        Changes of the copy, e.g. by a turn which fails, are only stored by put."""
+
+    @abstractmethod
+    def put(self, session_id: str, session: ChatSession) -> None:
+        """Saves the session after it was changed"""
+
+    @abstractmethod
+    def delete(self, session_id: str) -> None:
+        pass
+
+    async def get_async(self, session_id: str) -> ChatSession | None:
+        """Same as get, stores waiting for I/O do not block the event loop"""
+        return self.get(session_id)
+
+    async def put_async(self, session_id: str, session: ChatSession) -> None:
+        """Same as put, stores waiting for I/O do not block the event loop"""
+        self.put(session_id, session)
+
+    async def lock(self, session_id: str, timeout: float) -> str | None:
+        """Waits until no other process processes a turn of the session and returns a token to unlock it.
+        Returns None if the session stays locked for timeout seconds.
+        Stores local to a process are not shared, so they do not need to be locked."""
+        return ''
+
+    async def unlock(self, session_id: str, token: str) -> None:
+        pass
+
+    @abstractmethod
+    def metrics(self) -> dict:
+        """Returns the number of active sessions and the bytes held by them"""
+
+
+class InMemorySessionStore(SessionStore):
+    """Keeps the sessions in memory of the current process.
+    If there are too many sessions or they hold too much memory, the least recently used sessions are evicted."""
+
+    def __init__(self, ttl: float = 3600, max_sessions: int = 10000, max_bytes: int = 100 * 1024 * 1024):
+        super().__init__(ttl)
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.evicted_sessions = 0
+        # session id -> (time of last access, session, size in bytes), the least recently used session comes first
+        self.__sessions = OrderedDict()
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+
+    def get(self, session_id: str) -> ChatSession | None:
+        with self.__lock:
+            self.__evict_expired_sessions()
+            if session_id not in self.__sessions:
+                return None
+            _, session, size = self.__sessions[session_id]
+            self.__sessions[session_id] = (time.monotonic(), session, size)
+            self.__sessions.move_to_end(session_id)
+            return session.copy()
+
+    def put(self, session_id: str, session: ChatSession) -> None:
+        with self.__lock:
+            self.__remove(session_id)
+            size = session.size_in_bytes()
+            self.__sessions[session_id] = (time.monotonic(), session, size)
+            self.__bytes += size
+            self.__evict_expired_sessions()
+            while len(self.__sessions) > 1 and (
+                    len(self.__sessions) > self.max_sessions or self.__bytes > self.max_bytes):
+                self.__remove(next(iter(self.__sessions)))
+                self.evicted_sessions += 1
+
+    def delete(self, session_id: str) -> None:
+        with self.__lock:
+            self.__remove(session_id)
+
+    def metrics(self) -> dict:
+        return {'active_sessions': len(self.__sessions), 'bytes': self.__bytes,
+                'evicted_sessions': self.evicted_sessions}
+
+    def __evict_expired_sessions(self):
+        expired_before = time.monotonic() - self.ttl
+        while len(self.__sessions) > 0:
+            session_id, (last_access, _, _) = next(iter(self.__sessions.items()))
+            if last_access >= expired_before:
+                break
+            self.__remove(session_id)
+            self.evicted_sessions += 1
+
+    def __remove(self, session_id: str):
+        if session_id in self.__sessions:
+            self.__bytes -= self.__sessions.pop(session_id)[2]
+
+
+class SqliteSessionStore(SessionStore):
+    """Persists the sessions in a SQLite database, which can be shared by several worker processes.
+    The async methods access the database in a thread, because a write of another process may lock it."""
+
+    # the size of the sessions requires reading all of them, so the metrics are only updated every few seconds
+    metrics_interval = 30
+    # the lock of a session is released after this number of seconds if its process died during the turn
+    lock_ttl = 120
+    lock_poll_interval = 0.05
+
+    def __init__(self, path: str, ttl: float = 3600):
+        super().__init__(ttl)
+        self.__metrics = None
+        self.__metrics_time = 0.0
+        self.__connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self.__connection.execute('PRAGMA journal_mode=WAL')
+        self.__connection.execute('PRAGMA synchronous=NORMAL')
+        self.__connection.execute('CREATE TABLE IF NOT EXISTS sessions '
+                                  '(id TEXT PRIMARY KEY, data TEXT NOT NULL, last_access REAL NOT NULL)')
+        self.__connection.execute('CREATE INDEX IF NOT EXISTS sessions_last_access ON sessions (last_access)')
+        self.__connection.execute('CREATE TABLE IF NOT EXISTS session_locks '
+                                  '(id TEXT PRIMARY KEY, token TEXT NOT NULL, expires REAL NOT NULL)')
+        self.__lock = threading.Lock()
+
+    def get(self, session_id: str) -> ChatSession | None:
+        with self.__lock:
+            row = self.__connection.execute('SELECT data FROM sessions WHERE id = ? AND last_access >= ?',
+                                            (session_id, time.time() - self.ttl)).fetchone()
+        return ChatSession.from_dict(json.loads(row[0])) if row is not None else None
+
+    def put(self, session_id: str, session: ChatSession) -> None:
+        data = json.dumps(session.to_dict())
+        with self.__lock:
+            self.__connection.execute('INSERT OR REPLACE INTO sessions (id, data, last_access) VALUES (?, ?, ?)',
+                                      (session_id, data, time.time()))
+            self.__connection.execute('DELETE FROM sessions WHERE last_access < ?', (time.time() - self.ttl,))
+
+    def delete(self, session_id: str) -> None:
+        with self.__lock:
+            self.__connection.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
+
+    async def get_async(self, session_id: str) -> ChatSession | None:
+        return await asyncio.to_thread(self.get, session_id)
+
+    async def put_async(self, session_id: str, session: ChatSession) -> None:
+        await asyncio.to_thread(self.put, session_id, session)
+
+    async def lock(self, session_id: str, timeout: float) -> str | None:
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+        while not await asyncio.to_thread(self.__try_lock, session_id, token):
+            if time.monotonic() >= deadline:
+                return None
+            await asyncio.sleep(self.lock_poll_interval)
+        return token
+
+    async def unlock(self, session_id: str, token: str) -> None:
+        # the lock is released even if the turn is cancelled meanwhile
+        await asyncio.shield(asyncio.to_thread(self.__unlock, session_id, token))
+
+    def __try_lock(self, session_id: str, token: str) -> bool:
+        now = time.time()
+        with self.__lock:
+            cursor = self.__connection.execute(
+                'INSERT INTO session_locks (id, token, expires) VALUES (?, ?, ?) '
+                'ON CONFLICT (id) DO UPDATE SET token = excluded.token, expires = excluded.expires '
+                'WHERE session_locks.expires < ?', (session_id, token, now + self.lock_ttl, now))
+            return cursor.rowcount == 1
+
+    def __unlock(self, session_id: str, token: str):
+        with self.__lock:
+            self.__connection.execute('DELETE FROM session_locks WHERE id = ? AND token = ?', (session_id, token))
+
+    def metrics(self) -> dict:
+        if self.__metrics is not None and time.monotonic() - self.__metrics_time < self.metrics_interval:
+            return self.__metrics
+        with self.__lock:
+            active_sessions, size = self.__connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM sessions WHERE last_access >= ?',
+                (time.time() - self.ttl,)).fetchone()
+        self.__metrics = {'active_sessions': active_sessions, 'bytes': size}
+        self.__metrics_time = time.monotonic()
+        return self.__metrics
+
+
+def create_session_store() -> SessionStore:
+    """Creates the session store configured by the environment variable SESSION_STORE.
+    Use 'memory' (default) for a store local to the process or 'sqlite:<path>' for a store shared by processes."""
+    configuration = os.environ.get('SESSION_STORE', 'memory')
+    ttl = float(os.environ.get('SESSION_TTL', 3600))
+    if configuration.startswith('sqlite:'):
+        logging.info(f"Using SQLite session store {configuration}")
+        return SqliteSessionStore(configuration[len('sqlite:'):], ttl)
+    return InMemorySessionStore(ttl)
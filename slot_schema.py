@@ -0,0 +1,123 @@
+from datetime import datetime, time
+
+from dateutil import parser
+
+
+def is_not_in_past(value: str) -> bool:
+    parsed = parser.isoparse(value)
+    return parsed >= datetime.combine(datetime.now(tz=parsed.tzinfo), time.min, tzinfo=parsed.tzinfo)
+
+
+def is_full_name(value: str) -> bool:
+    return len(value.split(' ')) >= 2 and len(value) >= 5
+
+
+def is_whole_number(value: float) -> bool:
+    return float(int(value)) == float(value)
+
+
+class Slot:
+    """Declares a field of the booking: its row in the table queried from ChatGPT, how the value is parsed
+    (dim), how the bot asks for it and the rules a value has to satisfy.
+    Rules are tuples of a check of the parsed value and the message shown if the check fails.
+    The json schema describes the value returned by a function call of ChatGPT.
+    The information is how the instructions of the bot name the value the bot has to gather."""
+    __slots__ = ('attribute', 'dim', 'table_key', 'placeholder', 'label', 'json_schema', 'mandatory', 'in_summary',
+                 'keywords', 'question_keywords', 'parse_error', 'rules', 'information')
+
+    def __init__(self, attribute: str, dim: str, table_key: str, placeholder: str, label: str, json_schema: dict,
+                 keywords: tuple, question_keywords: tuple, mandatory: bool = False, in_summary: bool = True,
+                 parse_error: str | None = None, rules: tuple = (), information: str | None = None):
+        self.attribute = attribute
+        self.dim = dim
+        self.table_key = table_key
+        self.placeholder = placeholder
+        self.label = label
+        self.json_schema = json_schema
+        self.mandatory = mandatory
+        self.in_summary = in_summary
+        # words of the table key, used to find rows whose key ChatGPT did not write exactly like table_key
+        self.keywords = keywords
+        # phrases of a question of the bot asking for the value
+        self.question_keywords = question_keywords
+        self.parse_error = parse_error
+        self.rules = rules
+        self.information = information
+
+
+booking_slots = (
+    Slot('date_of_arrival', 'time', 'Date of arrival', 'date of arrival', 'Date of arrival',
+         {'type': 'string', 'description': 'date of arrival as YYYY-MM-DD'},
+         ('date', 'arrival'), ('arriv', 'date of', 'when'), mandatory=True,
+         parse_error='Sorry, I didn\'t unterstand. Could you please provide the date of your arrival?',
+         rules=((is_not_in_past, 'The booking date must not lie in the past.'),), information='date of arrival'),
+    Slot('duration_of_stay', 'duration', 'Duration of stay', 'number of nights', 'Duration of stay',
+         {'type': 'integer', 'description': 'number of nights'},
+         ('duration',), ('how long', 'night', 'duration'), mandatory=True,
+         parse_error='Could you please tell me how many nights you will stay?',
+         rules=((is_whole_number, 'The duration of stay must be a whole number of nights.'),),
+         information='duration of stay'),
+    Slot('number_of_guests', 'number', 'Number of guests', 'number of guests', 'Number of guests',
+         {'type': 'integer', 'description': 'number of guests'},
+         ('number', 'guest'), ('how many guest', 'how many people', 'how many person', 'number of guest'),
+         mandatory=True, parse_error='Sorry, I didn\'t unterstand. How many guests will stay at our hotel?',
+         rules=((is_whole_number, 'The number of guests must be a whole number.'),), information='number of guests'),
+    Slot('name_of_main_guest', 'text', 'Name of main guest', 'name of main guest', 'The name of the main guest',
+         {'type': 'string', 'description': 'first and last name of the main guest'},
+         ('name', 'guest'), ('name',), mandatory=True,
+         rules=((is_full_name, 'Please tell me your first and last name.'),), information='name of the main guest'),
+    Slot('email_address', 'email', 'Email address', 'email address', 'Email address',
+         {'type': 'string', 'description': 'email address of the main guest'},
+         ('email',), ('email', 'e-mail'), mandatory=True,
+         parse_error='Your email address is invalid. Could you please enter your correct email address?',
+         information='email address of the main guest'),
+    Slot('breakfast_included', 'bool', 'Breakfast included?', '(yes|no)', 'Does the guest want breakfast included?',
+         {'type': 'boolean', 'description': 'whether breakfast should be included'},
+         ('breakfast',), ('breakfast',), mandatory=True, information='whether breakfast should be included'),
+    Slot('booking_confirmed', 'bool', 'Did the user confirm a booking summary?', '(yes|no)',
+         'Did the user confirm the booking summary?',
+         {'type': 'boolean', 'description': 'whether the user confirmed the booking summary'},
+         ('confirm',), ('confirm',), in_summary=False),
+)
+
+# the rules are checked in this order and the message of the first rule failing is shown,
+# the rules of slots which are not listed are checked afterwards in the order of the schema
+rule_order = ('date_of_arrival', 'name_of_main_guest', 'number_of_guests', 'duration_of_stay')
+
+
+def create_table_query(slots: tuple = booking_slots) -> str:
+    """Creates the query for the booking information as table, worded exactly like the training data of the model"""
+    indentation = ' ' * 16
+    lines = ["List all booking-relevant information already provided by the user as table with exactly two columns ",
+             f"        and {len(slots)} rows of the form:"]
+    lines += [f"{indentation}{slot.table_key} | <{slot.placeholder}>" for slot in slots]
+    lines += [indentation,
+              f"{indentation}For any value not provided yet by me yet write [not provided] into the respective "
+              "cells of the table.",
+              indentation,
+              f"{indentation}Use the pipe symbol (|) as seperator between keys and values.",
+              f"{indentation}Remember: The table must have exactly two columns!",
+              ' ' * 12]
+    return '\n'.join(lines)
+
+
+def create_function_schema(slots: tuple = booking_slots) -> dict:
+    """Creates the function ChatGPT calls with the booking information, values not provided are left out"""
+    return {'name': 'record_booking_information',
+            'description': 'Records the booking information provided by the user so far',
+            'parameters': {'type': 'object',
+                           'properties': {slot.attribute: slot.json_schema for slot in slots},
+                           'required': []}}
+
+
+def create_information_list(conjunction: str = 'and', slots: tuple = booking_slots) -> str:
+    """Lists the information the bot has to gather for the instructions, e.g. 'date of arrival, ... and email'"""
+    information = [slot.information for slot in slots if slot.information is not None]
+    return f"{', '.join(information[:-1])} {conjunction} {information[-1]}" if len(information) > 1 \
+        else ''.join(information)
+
+
+def create_summary_rows(state, indentation: str = '') -> str:
+    """Returns the rows of the booking summary showing the values provided by the user"""
+    return f'\n{indentation}'.join(f"{slot.table_key}: {getattr(state, slot.attribute).raw_value}"
+                                   for slot in booking_slots if slot.in_summary)
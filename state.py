@@ -1,21 +1,55 @@
+from slot_schema import Slot, booking_slots
+
+
 class StateEntry:
-    def __init__(self, dim, keywords, label, mandatory=False):
-        self.dim = dim
-        self.keywords = keywords
-        self.label = label
-        self.mandatory = mandatory
+    """The raw and the parsed value of a slot"""
+    __slots__ = ('slot', 'value', 'raw_value')
+
+    def __init__(self, slot: Slot):
+        self.slot = slot
         self.value = None
         self.raw_value = None
 
+    @property
+    def dim(self) -> str:
+        return self.slot.dim
+
+    @property
+    def label(self) -> str:
+        return self.slot.label
+
+    @property
+    def mandatory(self) -> bool:
+        return self.slot.mandatory
+
 
 class State:
-    """Holds the most important information about the state of the conversation with the guest"""
+    """Holds the most important information about the state of the conversation with the guest.
+    There is one entry per slot of the booking schema, in the order of the schema."""
+    __slots__ = tuple(slot.attribute for slot in booking_slots)
 
     def __init__(self):
-        self.date_of_arrival = StateEntry('time', ['date', 'arrival'], 'Date of arrival', True)
-        self.duration_of_stay = StateEntry('duration', ['duration'], 'Duration of stay', True)
-        self.number_of_guests = StateEntry('number', ['number', 'guest'], 'Number of guests', True)
-        self.name_of_main_guest = StateEntry('text', ['name', 'guest'], 'The name of the main guest', True)
-        self.email_address = StateEntry('email', ['email'], 'Email address', True)
-        self.breakfast_included = StateEntry('bool', ['breakfast'], 'Does the guest want breakfast included?', True)
-        self.booking_confirmed = StateEntry('bool', ['confirm'], 'Did the user confirm the booking summary?')
+        for slot in booking_slots:
+            setattr(self, slot.attribute, StateEntry(slot))
+
+    def items(self):
+        """Returns the attributes and entries of all slots"""
+        return ((slot.attribute, getattr(self, slot.attribute)) for slot in booking_slots)
+
+    def values(self):
+        return (getattr(self, slot.attribute) for slot in booking_slots)
+
+    def to_dict(self) -> dict:
+        """Returns the raw and parsed values of all entries, e.g. to store the state"""
+        return {attribute: {'raw_value': entry.raw_value, 'value': entry.value} for attribute, entry in self.items()}
+
+    @staticmethod
+    def from_dict(values: dict) -> 'State':
+        """Values of slots which are no longer part of the schema are ignored"""
+        state = State()
+        for attribute, entry_values in values.items():
+            if attribute in State.__slots__:
+                entry = getattr(state, attribute)
+                entry.raw_value = entry_values['raw_value']
+                entry.value = entry_values['value']
+        return state
@@ -1,69 +1,296 @@
-import json
+import asyncio
+import datetime
 import logging
+import os
+import re
 from typing import Any
 
+from cache import MISSING
 from chat_gpt_adapter import ChatGptAdapter
 from duckling_adapter import DucklingAdapter
+from fast_path_extractor import FastPathExtractor
+import metrics
+import structured_logging
+from history_manager import HistoryManager
+from slot_schema import Slot, booking_slots, create_function_schema, create_table_query
 from state import State
 
+not_provided_pattern = re.compile(r"not provided|i don't know")
+non_word_pattern = re.compile(r"[^a-z0-9]+")
+
+
+def normalize_table_key(key: str) -> str:
+    """Ignores case, punctuation and whitespace, e.g. 'Breakfast included?' -> 'breakfast included'"""
+    return non_word_pattern.sub(' ', key.lower()).strip()
+
 
 class StateExtractor:
     """This class queries chatGPT and uses duckling to extract / parse to the respective data types"""
     duckling_adapter = DucklingAdapter()
+    history_manager = HistoryManager()
+    fast_path_extractor = FastPathExtractor()
+
+    structured_data_query = create_table_query()
+    booking_function = create_function_schema()
+
+    # 'function': ChatGPT calls booking_function with the booking information, most values are normalized already.
+    # 'table': the fine-tuned model returns the information as table, which is also the fallback of 'function'
+    extraction_mode = os.environ.get('STATE_EXTRACTION_MODE', 'function')
+
+    # normalized table keys of the slots, to find the slot of a row of the table with a single lookup
+    key_index = {normalize_table_key(slot.table_key): slot for slot in booking_slots}
+
+    # only send the newest exchange and the known values instead of the whole chat history if a state is known
+    incremental = True
 
-    structured_data_query = """List all booking-relevant information already provided by the user as table with exactly two columns 
-            and 7 rows of the form:
-                    Date of arrival | <date of arrival>
-                    Duration of stay | <number of nights>
-                    Number of guests | <number of guests>
-                    Name of main guest | <name of main guest>
-                    Email address | <email address>
-                    Breakfast included? | <(yes|no)>
-                    Did the user confirm a booking summary? | <(yes|no)>
+    # reuse the response of ChatGPT for the same query, e.g. the state after the first message is often the same
+    cache_responses = True
 
-                    For any value not provided yet by me yet write [not provided] into the respective cells of the table.
+    # fill the state locally if the user just answers the question of the bot, e.g. '2' to 'How many guests?'
+    fast_path = True
 
-                    Use the pipe symbol (|) as seperator between keys and values.
-                    Remember: The table must have exactly two columns!
-                """
+    def __init__(self):
+        self.fast_path_hits = 0
+        self.fast_path_fallbacks = 0
+        # estimated by the mean latency of the state queries sent to ChatGPT
+        self.fast_path_seconds_saved = 0.0
 
     def query_state(self, messages: list, chat_gpt_adapter: ChatGptAdapter) -> State:
         """Returns a state object given the chat history"""
-        chat_state_table = self.__query_chat_state_from_bot(messages, chat_gpt_adapter)
+        with metrics.span('query_state'):
+            if self.extraction_mode == 'function':
+                arguments = chat_gpt_adapter.function_call(
+                    self.__create_state_query(messages, self.__create_function_query()), self.booking_function, 0.2,
+                    chat_gpt_adapter.function_calling_model, self.cache_responses)
+                if arguments is not None:
+                    new_state, normalized = self.__create_state_from_arguments(arguments)
+                    return self.__parse_values(new_state, normalized)
+                self.__count_fallback()
+            chat_state_table = self.__query_chat_state_from_bot(messages, chat_gpt_adapter)
+            return self.__extract_values_from_chat_bot_response(chat_state_table)
+
+    def parse_table(self, chat_state_table: str) -> State:
+        """Returns the state described by a table like the ones returned for the state query,
+        e.g. to compare the expected state of a conversation with the state extracted"""
         return self.__extract_values_from_chat_bot_response(chat_state_table)
 
+    async def query_state_async(self, messages: list, chat_gpt_adapter: ChatGptAdapter,
+                                previous_state: State | None = None, expected_attribute: str | None = None) -> State:
+        """Same as query_state, but does not block the event loop while waiting for ChatGPT and duckling.
+        If the state of the previous turn is given, only the newest exchange is sent to ChatGPT
+        and the values returned are merged into the previous state.
+        The expected attribute is the missing field the bot asked for, an answer to it is parsed locally if possible."""
+        with metrics.span('query_state'):
+            if self.fast_path:
+                state = self.__query_state_from_fast_path(messages, previous_state, expected_attribute,
+                                                          chat_gpt_adapter)
+                if state is not None:
+                    return state
+            if not self.incremental:
+                previous_state = None
+            if self.extraction_mode == 'function':
+                state = await self.__query_state_by_function_call_async(messages, chat_gpt_adapter, previous_state)
+                if state is not None:
+                    return state
+                self.__count_fallback()
+            if previous_state is None:
+                copy_of_chat = self.__create_state_query(messages, self.structured_data_query)
+            else:
+                copy_of_chat = self.__create_incremental_state_query(messages, previous_state,
+                                                                     self.structured_data_query)
+            chat_state_table = await self.__query_chat_state_from_bot_async(copy_of_chat, chat_gpt_adapter)
+            return await self.__extract_values_from_chat_bot_response_async(chat_state_table, previous_state)
+
+    def __query_state_from_fast_path(self, messages: list, previous_state: State | None,
+                                     expected_attribute: str | None, adapter: ChatGptAdapter) -> State | None:
+        state = self.fast_path_extractor.extract(messages, previous_state, expected_attribute)
+        if state is None:
+            self.fast_path_fallbacks += 1
+            metrics.fast_path_extractions.inc('fallback')
+            return None
+        histogram = metrics.chat_gpt_request_duration.labels(
+            adapter.function_calling_model if self.extraction_mode == 'function' else adapter.structured_query_model)
+        seconds_saved = histogram.sum / histogram.count if histogram.count > 0 else 0.0
+        self.fast_path_hits += 1
+        self.fast_path_seconds_saved += seconds_saved
+        metrics.fast_path_extractions.inc('hit')
+        metrics.fast_path_seconds_saved.inc(amount=seconds_saved)
+        logging.info("State filled by the fast path, saved about %.2fs", seconds_saved)
+        return state
+
+    def fast_path_statistics(self) -> dict:
+        """Returns how often the fast path filled the state and the estimated latency saved"""
+        total = self.fast_path_hits + self.fast_path_fallbacks
+        return {'hits': self.fast_path_hits, 'fallbacks': self.fast_path_fallbacks,
+                'hit_rate': self.fast_path_hits / total if total > 0 else 0.0,
+                'seconds_saved': self.fast_path_seconds_saved}
+
+    async def __query_state_by_function_call_async(self, messages: list, adapter: ChatGptAdapter,
+                                                   previous_state: State | None) -> State | None:
+        """Returns None if ChatGPT did not call the function with valid arguments"""
+        logging.info('Enter _query_state_by_function_call_async')
+        query = self.__create_function_query()
+        copy_of_chat = self.__create_state_query(messages, query) if previous_state is None \
+            else self.__create_incremental_state_query(messages, previous_state, query)
+        arguments = await adapter.function_call_async(copy_of_chat, self.booking_function, 0.2,
+                                                      adapter.function_calling_model, self.cache_responses)
+        logging.debug("Arguments of the function call: %s", arguments)
+        if arguments is None:
+            return None
+        new_state, normalized = self.__create_state_from_arguments(arguments)
+        return await self.__merge_and_parse_values_async(new_state, previous_state, normalized)
+
+    def __count_fallback(self):
+        logging.warning("The booking information could not be queried by a function call, querying a table instead")
+        metrics.state_extraction_fallbacks.inc()
+
+    def __create_function_query(self) -> str:
+        # relative dates like 'tomorrow' can only be converted to dates if the current date is known
+        return f"Call {self.booking_function['name']} with all booking-relevant information provided by the user. " \
+               f"Leave out any value the user has not provided yet. Today is {datetime.date.today():%Y-%m-%d}."
+
+    def __create_state_from_arguments(self, arguments: dict) -> tuple[State, set]:
+        """Returns the state described by the arguments of the function call and the attributes
+        whose values are normalized already. The other values are parsed like the values of a table"""
+        new_state = State()
+        normalized = set()
+        for attribute, entry in new_state.items():
+            value = arguments.get(attribute)
+            if value is None or (isinstance(value, str) and (value.strip() == '' or
+                                                             not_provided_pattern.search(value.lower()))):
+                continue
+            if isinstance(value, bool):
+                entry.raw_value = 'Yes' if value else 'No'
+            else:
+                entry.raw_value = str(value)
+            normalized_value = self.__normalize_value(entry.dim, value)
+            if normalized_value is not MISSING:
+                entry.value = normalized_value
+                normalized.add(attribute)
+        return new_state, normalized
+
+    def __normalize_value(self, dim: str, value: Any) -> Any:
+        """Returns the value in the format of duckling or MISSING if it has to be parsed by duckling"""
+        match dim:
+            case 'bool':
+                return value if isinstance(value, bool) else MISSING
+            case 'number' | 'duration':
+                return value if isinstance(value, (int, float)) and not isinstance(value, bool) else MISSING
+            case 'time':
+                date = self.fast_path_extractor.parse_date(value) if isinstance(value, str) else None
+                return date if date is not None else MISSING
+            case 'email':
+                # an invalid email address is not parsed by duckling either
+                return self.fast_path_extractor.parse_email(value) if isinstance(value, str) else MISSING
+            case _:
+                return value if isinstance(value, str) else MISSING
+
     def __query_chat_state_from_bot(self, messages: list, adapter: ChatGptAdapter) -> str:
         """Queries information about the chat history and last chat message from ChatGPT."""
         logging.info('Enter _query_chat_state_from_bot')
-        copy_of_chat = messages.copy()
-        copy_of_chat.append(
-            {"role": "user", "content": self.structured_data_query})
+        copy_of_chat = self.__create_state_query(messages, self.structured_data_query)
+
+        booking_info_table = adapter.chat_completion(copy_of_chat, 0.2, adapter.structured_query_model,
+                                                     self.cache_responses)
+        structured_logging.log_history("Response to state query", copy_of_chat, booking_info_table)
+
+        return booking_info_table
 
-        booking_info_table = adapter.chat_completion(copy_of_chat, 0.2, adapter.structured_query_model)
-        logging.debug("Response to state query: " + json.dumps(copy_of_chat + [{"role": "assistant", "content": booking_info_table}]))
+    async def __query_chat_state_from_bot_async(self, copy_of_chat: list, adapter: ChatGptAdapter) -> str:
+        logging.info('Enter _query_chat_state_from_bot_async')
+        booking_info_table = await adapter.chat_completion_async(copy_of_chat, 0.2, adapter.structured_query_model,
+                                                                 self.cache_responses)
+        structured_logging.log_history("Response to state query", copy_of_chat, booking_info_table)
 
         return booking_info_table
 
+    def __create_state_query(self, messages: list, query: str) -> list:
+        copy_of_chat = self.history_manager.compact(messages).copy()
+        copy_of_chat.append(
+            {"role": "user", "content": query})
+        return copy_of_chat
+
+    def __create_incremental_state_query(self, messages: list, previous_state: State, query: str) -> list:
+        """Creates a state query containing the values known so far and the newest exchange of the chat"""
+        known_values = '\n'.join(f"{entry.slot.table_key} | {entry.raw_value or '[not provided]'}"
+                                  for entry in previous_state.values())
+        return [{"role": "system", "content": "You are a hotel booking assistant."},
+                {"role": "system", "content": f"Booking information provided by the user so far:\n{known_values}"}] + \
+            self.__create_state_query(self.__find_newest_exchange(messages), query)
+
+    @staticmethod
+    def __find_newest_exchange(messages: list) -> list:
+        """Returns the last messages of the user and the assistant message they respond to"""
+        start = len(messages)
+        while start > 0 and messages[start - 1]['role'] == 'user':
+            start -= 1
+        return messages[max(start - 1, 0):]
+
     def __extract_values_from_chat_bot_response(self, chat_state_table: str) -> State:
         """Extract values provided as text in form of a table into a State object"""
-        new_state = State()
-        lines = chat_state_table.split('\n')
-        for attribute, entry in new_state.__dict__.items():
-            matching_lines = list(
-                filter(lambda line: all(line.lower().find(keyword) > -1 for keyword in entry.keywords),
-                       lines))
-            if len(matching_lines) > 0:
-                parts = matching_lines[0].split('|')
-                raw_text_value = parts[2].strip() if len(parts) >= 3 else parts[1].strip()
-                entry.raw_value = raw_text_value if (raw_text_value.lower().find(
-                    'not provided') == -1 and raw_text_value.lower().find('i don\'t know') == -1) else None
+        return self.__parse_values(self.__extract_raw_values_from_chat_bot_response(chat_state_table), set())
+
+    def __parse_values(self, new_state: State, normalized: set) -> State:
+        for attribute, entry in new_state.items():
+            if attribute not in normalized:
                 entry.value = self.__extract_value(entry.dim, entry.raw_value)
-            else:
-                logging.warning(f"No value for key {attribute} found found in table data provided")
-                entry.raw_value = None
-                entry.value = None
         return new_state
 
+    async def __extract_values_from_chat_bot_response_async(self, chat_state_table: str,
+                                                            previous_state: State | None) -> State:
+        new_state = self.__extract_raw_values_from_chat_bot_response(chat_state_table)
+        return await self.__merge_and_parse_values_async(new_state, previous_state, set())
+
+    async def __merge_and_parse_values_async(self, new_state: State, previous_state: State | None,
+                                             normalized: set) -> State:
+        """Values which are not provided or did not change are taken from the previous state without parsing.
+        Values which are normalized already are not parsed either"""
+        entries_to_parse = []
+        for attribute, entry in new_state.items():
+            previous_entry = getattr(previous_state, attribute) if previous_state is not None else None
+            if previous_entry is not None and entry.raw_value in (None, previous_entry.raw_value):
+                entry.raw_value = previous_entry.raw_value
+                entry.value = previous_entry.value
+            elif attribute not in normalized:
+                entries_to_parse.append(entry)
+        # all values are parsed concurrently
+        values = await asyncio.gather(*[self.__extract_value_async(entry.dim, entry.raw_value)
+                                        for entry in entries_to_parse])
+        for entry, value in zip(entries_to_parse, values):
+            entry.value = value
+        return new_state
+
+    def __extract_raw_values_from_chat_bot_response(self, chat_state_table: str) -> State:
+        """Extract the text values of the table into a State object in a single pass over its rows.
+        The values are not parsed yet"""
+        new_state = State()
+        found = set()
+        for line in chat_state_table.split('\n'):
+            cells = line.strip().strip('|').split('|')
+            if len(cells) < 2:
+                continue
+            slot = self.__find_slot(cells[0])
+            # only the first row of a slot counts
+            if slot is None or slot.attribute in found:
+                continue
+            found.add(slot.attribute)
+            raw_text_value = cells[1].strip()
+            getattr(new_state, slot.attribute).raw_value = raw_text_value if raw_text_value and \
+                not_provided_pattern.search(raw_text_value.lower()) is None else None
+        for slot in booking_slots:
+            if slot.attribute not in found:
+                logging.warning(f"No value for key {slot.attribute} found found in table data provided")
+        return new_state
+
+    def __find_slot(self, key: str) -> Slot | None:
+        """Looks the key up in the index. Keys ChatGPT worded differently are matched by their keywords"""
+        normalized_key = normalize_table_key(key)
+        slot = self.key_index.get(normalized_key)
+        if slot is None:
+            slot = next((slot for slot in booking_slots
+                         if all(normalized_key.find(keyword) > -1 for keyword in slot.keywords)), None)
+        return slot
+
     def __extract_value(self, dim: str, value: str | None) -> Any:
         if value is None:
             return None
@@ -78,3 +305,18 @@ class StateExtractor:
                 return extracted_value
             case _:
                 return value
+
+    async def __extract_value_async(self, dim: str, value: str | None) -> Any:
+        if value is None:
+            return None
+        match dim:
+            case 'bool':
+                return value.lower().find('yes') > -1
+            case 'number' | 'time' | 'duration' | 'email':
+                extracted_value = await self.duckling_adapter.query_duckling_async(value, dim)
+                # fall back if there is no duration but just a number e.g. '2 nights'
+                if extracted_value is None and dim == 'duration':
+                    extracted_value = await self.duckling_adapter.query_duckling_async(value, 'number')
+                return extracted_value
+            case _:
+                return value
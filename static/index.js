@@ -43,20 +43,20 @@ $(document).ready(() => {
             while(lengthOf(msgHistory) > 3000) {
                 msgHistory = msgHistory.slice(1)
             }
-            const response = await fetch('/chat/', {
-                method: 'POST',
-                headers: {
-                    "Content-Type": "application/json"
-                },
-                body: JSON.stringify({ text: message, sessionId })
-            })
-            const answer = await response.json()
+            const answer = await streamResponse(message)
+            if (answer.rejected) {
+                // the message was not answered, so the user can send it again
+                msgHistory.pop()
+                $('.text-box')[0].value = message
+                showResponse(answer.text)
+                return false
+            }
             msgHistory.push({ role: 'assistant', content: answer.text })
             if (answer.flag === 'booking_finished') {
               $('#sendMessage').text('Restart')
               $('#sendMessage').click(() => window.location.reload())
             }
-            $('.messages').children().last()[0].innerHTML = `<span>${answer.text.replace(/\n/g, '<br/>')}</span>`
+            showResponse(answer.text)
 
             return answer.flag === 'booking_finished'
         } catch (e) {
@@ -68,6 +68,63 @@ $(document).ready(() => {
         }, 250);
     }
 
+    function showResponse(text) {
+        $('.messages').children().last()[0].innerHTML = `<span>${text.replace(/\n/g, '<br/>')}</span>`
+    }
+
+    // The response is sent as server-sent events. Each event contains the next part of the text ('delta'),
+    // the last event contains the complete response, which replaces the parts shown so far.
+    // Retries send the same idempotency key, so the server answers a message only once.
+    // Messages rejected because the server is busy (503) or the previous message is still being answered (429)
+    // are sent again after the time given by the Retry-After header
+    async function streamResponse(message) {
+        const idempotencyKey = crypto.randomUUID()
+        let response
+        for (let attempt = 1; ; attempt++) {
+            try {
+                response = await fetch('/chat/stream/', {
+                    method: 'POST',
+                    headers: {
+                        "Content-Type": "application/json",
+                        "Idempotency-Key": idempotencyKey
+                    },
+                    body: JSON.stringify({ text: message, sessionId })
+                })
+            } catch (e) {
+                if (attempt >= 3) throw e
+                await new Promise(resolve => setTimeout(resolve, 1000 * attempt))
+                continue
+            }
+            if ((response.status !== 503 && response.status !== 429) || attempt >= 3) break
+            const retryAfter = Number(response.headers.get('Retry-After') || 1)
+            await new Promise(resolve => setTimeout(resolve, 1000 * retryAfter))
+        }
+        // rejected messages are answered with a json object containing the text to show
+        if (!response.ok) {
+            return { ...await response.json(), rejected: true }
+        }
+        const reader = response.body.pipeThrough(new TextDecoderStream()).getReader()
+        let buffer = ''
+        let partialText = ''
+        while (true) {
+            const { value, done } = await reader.read()
+            if (done) {
+                throw new Error('The response ended unexpectedly')
+            }
+            buffer += value
+            const events = buffer.split('\n\n')
+            buffer = events.pop()
+            for (const event of events) {
+                const data = JSON.parse(event.replace(/^data: /, ''))
+                if (data.delta === undefined) {
+                    return data
+                }
+                partialText += data.delta
+                showResponse(partialText)
+            }
+        }
+    }
+
     async function sendNewMessage() {
         var userInput = $('.text-box');
         var newMessage = userInput[0].value;
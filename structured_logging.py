@@ -0,0 +1,98 @@
+"""Logging which keeps the cost of log records off the event loop.
+
+Records of levels no handler emits are not created at all. The other records are handed to a background thread
+through a queue, which formats and writes them. Pass values as arguments (logging.info("... %s", value))
+instead of f-strings, so they are only formatted if the record is emitted, and do not change them afterwards.
+JsonFormatter writes every record as one json object including the session id of the turn.
+
+Set LOG_HISTORY_SAMPLE_RATE to the fraction of full chat histories logged at debug level, e.g. 0.01 under load,
+and LOG_QUEUE_SIZE to the number of records waiting for the writer before new records are dropped."""
+import atexit
+import contextvars
+import datetime
+import json
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+import metrics
+
+# the session of the turn being processed, added to every record logged by the turn
+current_session_id = contextvars.ContextVar('current_session_id', default=None)
+
+history_sample_rate = float(os.environ.get('LOG_HISTORY_SAMPLE_RATE', 1.0))
+queue_size = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as json object in a single line. Values passed as extra={'fields': {...}}
+    are added to the object."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc)
+                 .isoformat(timespec='milliseconds'),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'thread': record.thread,
+                 'session_id': getattr(record, 'session_id', current_session_id.get()),
+                 'message': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """Hands the records to the writer thread without formatting them. Records are dropped instead of
+    blocking the caller if the writer falls behind."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the context of the turn is not available in the writer thread
+        record.session_id = current_session_id.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.dropped_log_records.inc()
+
+
+def start_background_logging():
+    """Moves the handlers of the root logger behind a queue emptied by a background thread"""
+    global _listener
+    root = logging.getLogger()
+    if _listener is not None or len(root.handlers) == 0:
+        return
+    handlers = root.handlers[:]
+    # loggers check their level before creating a record, handlers only afterwards
+    root.setLevel(max(root.getEffectiveLevel(), min(handler.level for handler in handlers)))
+    log_queue = queue.Queue(queue_size)
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    root.handlers = [BackgroundQueueHandler(log_queue)]
+    _listener.start()
+    atexit.register(stop_background_logging)
+
+
+def stop_background_logging():
+    """Writes the records left in the queue and gives the handlers back to the root logger"""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    logging.getLogger().handlers = list(_listener.handlers)
+    _listener = None
+
+
+def log_history(message: str, messages: list, reply: str | None = None):
+    """Logs the chat history and the reply of the bot at debug level for a sample of the calls"""
+    if not logging.getLogger().isEnabledFor(logging.DEBUG) or random.random() >= history_sample_rate:
+        return
+    history = messages + [{"role": "assistant", "content": reply}] if reply is not None else list(messages)
+    logging.debug(message, extra={'fields': {'history': history}})
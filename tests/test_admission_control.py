@@ -0,0 +1,154 @@
+import asyncio
+
+import pytest
+
+import server
+from admission_control import AdmissionController, TurnRejected
+from session_store import SqliteSessionStore
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_turns_of_a_session_are_processed_one_after_another():
+    async def test():
+        controller = AdmissionController()
+        order = []
+
+        async def turn(name: str):
+            async with controller.admit('a'):
+                order.append(f'{name} start')
+                await asyncio.sleep(0.01)
+                order.append(f'{name} end')
+
+        await asyncio.gather(turn('first'), turn('second'))
+        assert order == ['first start', 'first end', 'second start', 'second end']
+        assert controller.statistics() == {'running_turns': 0, 'waiting_turns': 0, 'sessions': 0}
+
+    run(test())
+
+
+def test_too_many_turns_of_a_session_are_rejected():
+    async def test():
+        controller = AdmissionController(max_turns_per_session=2)
+        await controller.acquire('a')
+        waiting = asyncio.create_task(controller.acquire('a'))
+        await asyncio.sleep(0.01)
+        with pytest.raises(TurnRejected) as rejection:
+            await controller.acquire('a')
+        assert (rejection.value.status_code, rejection.value.retry_after) == (429, 1)
+        # other sessions are not affected
+        await controller.acquire('b')
+        await controller.release('b')
+        await controller.release('a')
+        await waiting
+        await controller.release('a')
+        assert controller.statistics() == {'running_turns': 0, 'waiting_turns': 0, 'sessions': 0}
+
+    run(test())
+
+
+def test_turns_waiting_too_long_for_the_session_are_rejected():
+    async def test():
+        controller = AdmissionController(max_waiting_time=0.05)
+        await controller.acquire('a')
+        with pytest.raises(TurnRejected) as rejection:
+            await controller.acquire('a')
+        assert rejection.value.status_code == 429
+        await controller.release('a')
+        assert controller.statistics() == {'running_turns': 0, 'waiting_turns': 0, 'sessions': 0}
+
+    run(test())
+
+
+def test_turns_exceeding_the_limits_are_rejected():
+    async def test():
+        controller = AdmissionController(max_concurrent_turns=1, max_waiting_turns=1, max_waiting_time=0.05)
+        await controller.acquire('a')
+        waiting = asyncio.create_task(controller.acquire('b'))
+        await asyncio.sleep(0.01)
+        assert controller.statistics() == {'running_turns': 1, 'waiting_turns': 1, 'sessions': 2}
+        # the queue is full
+        with pytest.raises(TurnRejected) as rejection:
+            await controller.acquire('c')
+        assert (rejection.value.status_code, rejection.value.retry_after) == (503, 5)
+        # the waiting turn times out
+        with pytest.raises(TurnRejected) as rejection:
+            await waiting
+        assert rejection.value.status_code == 503
+        await controller.release('a')
+        assert controller.statistics() == {'running_turns': 0, 'waiting_turns': 0, 'sessions': 0}
+        # the slot of the released turn can be used again
+        await controller.acquire('c')
+        await controller.release('c')
+
+    run(test())
+
+
+def test_cancelled_turns_leave_the_queue():
+    async def test():
+        controller = AdmissionController(max_concurrent_turns=1)
+        await controller.acquire('a')
+        waiting = [asyncio.create_task(controller.acquire(session_id)) for session_id in ('a', 'b')]
+        await asyncio.sleep(0.01)
+        for task in waiting:
+            task.cancel()
+        await asyncio.gather(*waiting, return_exceptions=True)
+        await controller.release('a')
+        assert controller.statistics() == {'running_turns': 0, 'waiting_turns': 0, 'sessions': 0}
+
+    run(test())
+
+
+def test_turns_of_a_session_are_serialized_across_processes(tmp_path):
+    async def test():
+        # two processes sharing the session store
+        store = SqliteSessionStore(str(tmp_path / 'sessions.db'))
+        controllers = [AdmissionController(max_waiting_time=1, session_store=store) for _ in range(2)]
+        await controllers[0].acquire('a')
+        waiting = asyncio.create_task(controllers[1].acquire('a'))
+        await asyncio.sleep(0.2)
+        assert not waiting.done()
+        await controllers[0].release('a')
+        await waiting
+        await controllers[1].release('a')
+        # a session locked for too long is rejected
+        controllers[1].max_waiting_time = 0.1
+        await controllers[0].acquire('a')
+        with pytest.raises(TurnRejected) as rejection:
+            await controllers[1].acquire('a')
+        assert rejection.value.status_code == 429
+        await controllers[0].release('a')
+        assert controllers[1].statistics() == {'running_turns': 0, 'waiting_turns': 0, 'sessions': 0}
+
+    run(test())
+
+
+@pytest.mark.parametrize('receive_message, send_error', [
+    # the client disconnects right away
+    ({'type': 'http.disconnect'}, None),
+    # the connection is lost before the response starts, so the events are never generated
+    (None, ConnectionResetError()),
+])
+def test_streamed_turns_are_released_if_the_response_is_cancelled(receive_message, send_error):
+    async def test():
+        response = await server.stream_msg(server.Message(sessionId='stream', text='hi'), None)
+        assert server.admission_controller.statistics()['running_turns'] == 1
+
+        async def receive():
+            if receive_message is None:
+                await asyncio.sleep(10)
+            return receive_message
+
+        async def send(message):
+            if send_error is not None:
+                raise send_error
+
+        try:
+            await response({'type': 'http'}, receive, send)
+        except ConnectionResetError:
+            pass
+        assert server.admission_controller.statistics() == {'running_turns': 0, 'waiting_turns': 0, 'sessions': 0}
+
+    run(test())
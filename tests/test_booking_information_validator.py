@@ -0,0 +1,52 @@
+import datetime
+
+import pytest
+
+from booking_information_validator import BookingInformationValidator
+from state import State
+
+future_date = (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=30)).isoformat()
+past_date = '2020-01-01T00:00:00.000+00:00'
+valid = {'date_of_arrival': ('10th of November', future_date), 'duration_of_stay': ('3 nights', 3.0),
+         'number_of_guests': ('2', 2), 'name_of_main_guest': ('John Smith', 'John Smith'),
+         'email_address': ('john@example.com', 'john@example.com'), 'breakfast_included': ('Yes', True)}
+
+
+def create_state(**entries) -> State:
+    state = State()
+    for attribute, (raw_value, value) in (valid | entries).items():
+        entry = getattr(state, attribute)
+        entry.raw_value, entry.value = raw_value, value
+    return state
+
+
+# the messages and their precedence are the ones of the validator before the slot schema was introduced
+@pytest.mark.parametrize('entries, expected', [
+    ({}, None),
+    ({'date_of_arrival': ('soon', None)},
+     "Sorry, I didn't unterstand. Could you please provide the date of your arrival?"),
+    ({'duration_of_stay': ('a while', None)}, 'Could you please tell me how many nights you will stay?'),
+    ({'number_of_guests': ('some', None)}, "Sorry, I didn't unterstand. How many guests will stay at our hotel?"),
+    ({'email_address': ('foo@bla', None)},
+     'Your email address is invalid. Could you please enter your correct email address?'),
+    ({'date_of_arrival': (None, None), 'number_of_guests': (None, None)}, None),
+    ({'date_of_arrival': ('1.1.2020', past_date)}, 'The booking date must not lie in the past.'),
+    ({'name_of_main_guest': ('John', 'John')}, 'Please tell me your first and last name.'),
+    ({'number_of_guests': ('2.5', 2.5)}, 'The number of guests must be a whole number.'),
+    ({'duration_of_stay': ('1.5 nights', 1.5)}, 'The duration of stay must be a whole number of nights.'),
+    # values which could not be parsed come first
+    ({'email_address': ('foo@bla', None), 'date_of_arrival': ('1.1.2020', past_date)},
+     'Your email address is invalid. Could you please enter your correct email address?'),
+    ({'date_of_arrival': ('soon', None), 'number_of_guests': ('some', None)},
+     "Sorry, I didn't unterstand. Could you please provide the date of your arrival?"),
+    # then the rules in the order date, name, number of guests, duration
+    ({'duration_of_stay': ('1.5 nights', 1.5), 'name_of_main_guest': ('John', 'John')},
+     'Please tell me your first and last name.'),
+    ({'duration_of_stay': ('1.5 nights', 1.5), 'number_of_guests': ('2.5', 2.5)},
+     'The number of guests must be a whole number.'),
+    ({'number_of_guests': ('2.5', 2.5), 'name_of_main_guest': ('John', 'John'),
+      'date_of_arrival': ('1.1.2020', past_date)}, 'The booking date must not lie in the past.'),
+])
+def test_validate(entries, expected):
+    result = BookingInformationValidator().validate(create_state(**entries))
+    assert result == {'has_error': expected is not None, 'error_msg': expected}
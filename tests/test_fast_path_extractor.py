@@ -0,0 +1,137 @@
+import datetime
+
+import pytest
+
+from fast_path_extractor import FastPathExtractor
+from state import State
+
+today = datetime.date(2026, 10, 18)
+
+
+@pytest.mark.parametrize('answer, expected', [
+    ('today', datetime.date(2026, 10, 18)),
+    ('tomorrow', datetime.date(2026, 10, 19)),
+    ('2026-11-10', datetime.date(2026, 11, 10)),
+    ('10.11.', datetime.date(2026, 11, 10)),
+    ('10.11.2027', datetime.date(2027, 11, 10)),
+    ('10th of November', datetime.date(2026, 11, 10)),
+    ('November 10, please', datetime.date(2026, 11, 10)),
+    ('I arrive on the 3rd of March', datetime.date(2027, 3, 3)),
+    ('10/11', None),
+    ('31.02.', None),
+    ('next week', None),
+])
+def test_parse_date(answer, expected):
+    value = FastPathExtractor.parse_date(answer, today)
+    if expected is None:
+        assert value is None
+        return
+    parsed = datetime.datetime.fromisoformat(value)
+    assert parsed.date() == expected
+    # midnight of the local time zone, like duckling
+    assert parsed == datetime.datetime.combine(expected, datetime.time()).astimezone()
+
+
+@pytest.mark.parametrize('answer, expected', [
+    ('John Smith', 'John Smith'),
+    ('My name is Mary Ann Jones', 'Mary Ann Jones'),
+    ('john smith', None),
+    ('Smith', None),
+    ('No Idea', None),
+    ('Thank You', None),
+    ('Yes Please', None),
+    ('I Don\'t Know', None),
+])
+def test_parse_name(answer, expected):
+    assert FastPathExtractor.parse_name(answer) == expected
+
+
+@pytest.mark.parametrize('answer, expected', [
+    ('2', 2),
+    ('two', 2),
+    ('We are 3 guests', 3),
+    ('2 adults, thanks', 2),
+    ('2 nights', None),
+    ('maybe 2', None),
+])
+def test_parse_number(answer, expected):
+    assert FastPathExtractor.parse_number(answer) == expected
+
+
+@pytest.mark.parametrize('answer, expected', [
+    ('3 nights', 3.0),
+    ('a week', 7.0),
+    ('two days', 2.0),
+    ('3', 3),
+    ('two guests', None),
+    ('until Sunday', None),
+])
+def test_parse_duration(answer, expected):
+    assert FastPathExtractor.parse_duration(answer) == expected
+
+
+@pytest.mark.parametrize('answer, expected', [
+    ('john@example.com', 'john@example.com'),
+    ('My email is J.Doe@Example.com, thanks', 'J.Doe@Example.com'),
+    ('john@example', None),
+])
+def test_parse_email(answer, expected):
+    assert FastPathExtractor.parse_email(answer) == expected
+
+
+def create_state(**values) -> State:
+    state = State()
+    for attribute, value in values.items():
+        getattr(state, attribute).value = value
+    return state
+
+
+@pytest.mark.parametrize('messages, previous_state, expected_attribute, expected', [
+    ([{'role': 'user', 'content': 'tomorrow'}], None, 'date_of_arrival', 'date_of_arrival'),
+    ([{'role': 'assistant', 'content': 'Great! How many guests will stay at our hotel?'},
+      {'role': 'user', 'content': '2'}], None, 'date_of_arrival', 'number_of_guests'),
+    ([{'role': 'assistant', 'content': 'How many nights will you stay?'},
+      {'role': 'user', 'content': '3'}], None, 'duration_of_stay', 'duration_of_stay'),
+    # the question refers to two fields
+    ([{'role': 'assistant', 'content': 'What is your name and email address?'},
+      {'role': 'user', 'content': 'John Smith'}], None, 'name_of_main_guest', None),
+    # no question asked
+    ([{'role': 'assistant', 'content': 'Breakfast costs $10 per guest and night.'},
+      {'role': 'user', 'content': 'yes'}], None, 'breakfast_included', None),
+    # the field is known already
+    ([{'role': 'assistant', 'content': 'How many guests will stay?'},
+      {'role': 'user', 'content': '2'}], create_state(number_of_guests=3), 'email_address', None),
+    # the booking can not be confirmed while information is missing
+    ([{'role': 'assistant', 'content': 'Do you confirm the booking?'},
+      {'role': 'user', 'content': 'yes'}], None, 'email_address', None),
+    ([{'role': 'assistant', 'content': 'Do you confirm the booking?'},
+      {'role': 'user', 'content': 'yes'}], None, None, 'booking_confirmed'),
+    ([{'role': 'user', 'content': 'hi'}, {'role': 'user', 'content': '2'}], None, 'number_of_guests', None),
+])
+def test_find_asked_attribute(messages, previous_state, expected_attribute, expected):
+    extractor = FastPathExtractor()
+    assert extractor._FastPathExtractor__find_asked_attribute(messages, previous_state, expected_attribute) == expected
+
+
+@pytest.mark.parametrize('question, answer, attribute, raw_value, value', [
+    ('How many guests will stay?', 'We are 3 guests, thanks', 'number_of_guests', '3', 3),
+    ('How many nights will you stay?', 'a week', 'duration_of_stay', '7', 7.0),
+    ('How many nights will you stay?', '2 nights please', 'duration_of_stay', '2', 2.0),
+    ('What is your email address?', 'My email is J.Doe@Example.com, thanks', 'email_address', 'J.Doe@Example.com',
+     'J.Doe@Example.com'),
+    ('What is your name?', 'My name is John Smith.', 'name_of_main_guest', 'John Smith', 'John Smith'),
+    ('Would you like to have breakfast included?', 'Yes please!', 'breakfast_included', 'Yes', True),
+])
+def test_extract(question, answer, attribute, raw_value, value):
+    messages = [{'role': 'assistant', 'content': question}, {'role': 'user', 'content': answer}]
+    state = FastPathExtractor().extract(messages, None, 'date_of_arrival')
+    entry = getattr(state, attribute)
+    # the raw value is shown in the summary, so it holds the value without the rest of the answer
+    assert (entry.raw_value, entry.value) == (raw_value, value)
+
+
+def test_extract_date():
+    messages = [{'role': 'user', 'content': 'I arrive on the 2026-11-10'}]
+    entry = FastPathExtractor().extract(messages, None, 'date_of_arrival').date_of_arrival
+    assert entry.raw_value == '2026-11-10'
+    assert datetime.datetime.fromisoformat(entry.value) == datetime.datetime(2026, 11, 10).astimezone()
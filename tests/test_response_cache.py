@@ -0,0 +1,94 @@
+import asyncio
+import time
+
+import pytest
+
+from chat_gpt_adapter import ChatGptAdapter
+from response_cache import ResponseCache
+
+messages = [{'role': 'system', 'content': 'You are a hotel receptionist.'}, {'role': 'user', 'content': 'Hello'}]
+
+
+def test_keys():
+    key = ResponseCache.create_key('model', messages, 0.5)
+    # messages which only differ in whitespace have the same key
+    assert ResponseCache.create_key('model', [{'role': 'system', 'content': ' You are a  hotel\nreceptionist.'},
+                                              {'role': 'user', 'content': 'Hello '}], 0.5) == key
+    assert ResponseCache.create_key('other model', messages, 0.5) != key
+    assert ResponseCache.create_key('model', messages, 0.2) != key
+    assert ResponseCache.create_key('model', messages[1:], 0.5) != key
+    assert ResponseCache.create_key('model', messages, 0.5, {'name': 'store_booking'}) != key
+
+
+def test_responses_are_kept_on_disk(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / 'responses.db'))
+    cache.put('key', 'response')
+    assert cache.get('key') == 'response'
+    assert cache.get('other key') is None
+    # e.g. after a restart
+    cache = ResponseCache(path=str(tmp_path / 'responses.db'))
+    assert asyncio.run(cache.get_async('key')) == 'response'
+    assert cache.statistics()['disk_hits'] == 1
+    # found in memory afterwards
+    assert cache.get('key') == 'response'
+    assert cache.statistics()['disk_hits'] == 1
+
+
+def test_responses_expire(tmp_path):
+    cache = ResponseCache(ttl=0.05, path=str(tmp_path / 'responses.db'))
+    asyncio.run(cache.put_async('key', 'response'))
+    time.sleep(0.1)
+    assert cache.get('key') is None
+    assert ResponseCache(path=str(tmp_path / 'responses.db')).get('key') is None
+
+
+@pytest.fixture
+def adapter(monkeypatch):
+    """An adapter whose requests to ChatGPT are answered with their number, the requests numbered in
+    failing_requests fail"""
+    adapter = ChatGptAdapter()
+    adapter.requests = 0
+    adapter.failing_requests = set()
+
+    async def complete(messages, temperature, model, function=None):
+        adapter.requests += 1
+        if adapter.requests in adapter.failing_requests:
+            raise TimeoutError()
+        return f'response {adapter.requests}'
+
+    monkeypatch.setattr(adapter, '_ChatGptAdapter__chat_completion_with_timeout_async', complete)
+    return adapter
+
+
+def test_responses_are_cached(adapter):
+    async def test():
+        assert await adapter.chat_completion_async(messages) == 'response 1'
+        assert await adapter.chat_completion_async(messages) == 'response 1'
+        assert await adapter.chat_completion_async(messages, temperature=0.2) == 'response 2'
+        assert adapter.requests == 2
+        assert adapter.response_cache.statistics()['hits'] == 1
+
+    asyncio.run(test())
+
+
+def test_responses_are_not_cached_if_opted_out(adapter):
+    async def test():
+        assert await adapter.chat_completion_async(messages) == 'response 1'
+        # a request opting out is sent even if the response is cached
+        assert await adapter.chat_completion_async(messages, use_cache=False) == 'response 2'
+        # and its response is not stored
+        assert await adapter.chat_completion_async(messages, temperature=0.2, use_cache=False) == 'response 3'
+        assert await adapter.chat_completion_async(messages, temperature=0.2) == 'response 4'
+        assert adapter.requests == 4
+
+    asyncio.run(test())
+
+
+def test_errors_are_not_cached(adapter):
+    async def test():
+        adapter.failing_requests = {1}
+        assert await adapter.chat_completion_async(messages) == adapter.error_message
+        assert await adapter.chat_completion_async(messages) == 'response 2'
+        assert await adapter.chat_completion_async(messages) == 'response 2'
+
+    asyncio.run(test())
@@ -0,0 +1,113 @@
+import asyncio
+import time
+
+import pytest
+
+from chat_session import ChatSession
+from session_store import InMemorySessionStore, SqliteSessionStore
+
+
+def create_session(*texts: str) -> ChatSession:
+    session = ChatSession()
+    session.messages = [{'role': 'user', 'content': text} for text in texts]
+    return session
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    return InMemorySessionStore() if request.param == 'memory' else SqliteSessionStore(str(tmp_path / 'sessions.db'))
+
+
+def test_get_returns_the_stored_session(store):
+    store.put('a', create_session('hi'))
+    assert store.get('a').messages == [{'role': 'user', 'content': 'hi'}]
+    assert store.get('b') is None
+
+
+def test_changes_are_only_stored_by_put(store):
+    store.put('a', create_session('hi'))
+    session = store.get('a')
+    # e.g. a turn which failed after appending the message of the user
+    session.messages.append({'role': 'user', 'content': 'lost'})
+    session.replies['key'] = {'text': 'lost'}
+    assert store.get('a').messages == [{'role': 'user', 'content': 'hi'}]
+    assert store.get('a').replies == {}
+    store.put('a', session)
+    assert len(store.get('a').messages) == 2
+
+
+def test_expired_sessions_are_discarded(store):
+    store.ttl = 0.05
+    store.put('a', create_session('hi'))
+    time.sleep(0.1)
+    assert store.get('a') is None
+
+
+def test_delete(store):
+    store.put('a', create_session('hi'))
+    store.delete('a')
+    assert store.get('a') is None
+
+
+@pytest.mark.parametrize('max_sessions, max_bytes, expected', [
+    # the least recently used session is evicted first, 'a' was used after 'b'
+    (2, 1000, ['a', 'c']),
+    (3, 1000, ['a', 'b', 'c']),
+    # every session holds 10 bytes
+    (10, 25, ['a', 'c']),
+    (10, 15, ['c']),
+    # the newest session is kept even if it is larger than the limit
+    (10, 5, ['c']),
+])
+def test_least_recently_used_sessions_are_evicted(max_sessions, max_bytes, expected):
+    store = InMemorySessionStore(max_sessions=max_sessions, max_bytes=max_bytes)
+    store.put('a', create_session('0123456789'))
+    store.put('b', create_session('0123456789'))
+    store.get('a')
+    store.put('c', create_session('0123456789'))
+    assert [session_id for session_id in 'abc' if store.get(session_id) is not None] == expected
+    assert store.metrics()['active_sessions'] == len(expected)
+    assert store.metrics()['bytes'] == 10 * len(expected)
+    assert store.metrics()['evicted_sessions'] == 3 - len(expected)
+
+
+def test_sessions_are_locked_until_unlocked(tmp_path):
+    async def test():
+        store = SqliteSessionStore(str(tmp_path / 'sessions.db'))
+        token = await store.lock('a', 1)
+        assert token is not None
+        assert await store.lock('a', 0.1) is None
+        # other sessions are not locked
+        await store.unlock('b', await store.lock('b', 0.1))
+        # only the holder of the lock can unlock the session
+        await store.unlock('a', 'other token')
+        assert await store.lock('a', 0.1) is None
+        await store.unlock('a', token)
+        assert await store.lock('a', 0.1) is not None
+
+    asyncio.run(test())
+
+
+def test_locks_expire(tmp_path):
+    async def test():
+        # e.g. the process holding the lock died
+        store = SqliteSessionStore(str(tmp_path / 'sessions.db'))
+        store.lock_ttl = 0.2
+        token = await store.lock('a', 1)
+        assert await store.lock('a', 0.05) is None
+        new_token = await store.lock('a', 1)
+        assert new_token not in (None, token)
+        # the expired lock can not unlock the session locked again
+        await store.unlock('a', token)
+        assert await store.lock('a', 0.05) is None
+
+    asyncio.run(test())
+
+
+def test_local_stores_are_not_locked():
+    async def test():
+        store = InMemorySessionStore()
+        assert await store.lock('a', 0.1) is not None
+        assert await store.lock('a', 0.1) is not None
+
+    asyncio.run(test())
@@ -0,0 +1,17 @@
+import json
+import os
+
+from slot_schema import booking_slots, create_information_list, create_table_query
+
+
+def test_table_query_is_worded_like_the_training_data():
+    with open(os.path.join(os.path.dirname(__file__), '..', 'training', 'structured-output.jsonl')) as file:
+        messages = json.loads(file.readline())['messages']
+    assert create_table_query() in [message['content'] for message in messages if message['role'] == 'user']
+
+
+def test_information_list_names_every_mandatory_slot():
+    information = create_information_list('or')
+    assert information.startswith('date of arrival, duration of stay, ')
+    assert information.endswith(' or whether breakfast should be included')
+    assert all(information.find(slot.information) > -1 for slot in booking_slots if slot.mandatory)
@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from state import State
+from state_extractor import StateExtractor
+
+
+def create_state(**entries) -> State:
+    state = State()
+    for attribute, (raw_value, value) in entries.items():
+        entry = getattr(state, attribute)
+        entry.raw_value, entry.value = raw_value, value
+    return state
+
+
+# the names and yes/no values are parsed without duckling, the number of guests is normalized already
+@pytest.mark.parametrize('new_entries, previous_entries, normalized, expected', [
+    # without a previous state every value is parsed
+    ({'name_of_main_guest': ('John Smith', None), 'breakfast_included': ('Yes', None)}, None, set(),
+     {'name_of_main_guest': ('John Smith', 'John Smith'), 'breakfast_included': ('Yes', True)}),
+    # a value not provided keeps the previous value
+    ({}, {'name_of_main_guest': ('John Smith', 'John Smith'), 'breakfast_included': ('No', False)}, set(),
+     {'name_of_main_guest': ('John Smith', 'John Smith'), 'breakfast_included': ('No', False)}),
+    # an unchanged raw value keeps the previous value, even if it would be parsed differently now
+    ({'breakfast_included': ('No', None)}, {'breakfast_included': ('No', 'previous')}, set(),
+     {'breakfast_included': ('No', 'previous')}),
+    # a changed raw value is parsed again
+    ({'breakfast_included': ('Yes please', None)}, {'breakfast_included': ('No', False)}, set(),
+     {'breakfast_included': ('Yes please', True)}),
+    # a normalized value is not parsed
+    ({'number_of_guests': ('3', 3)}, {'number_of_guests': ('2', 2)}, {'number_of_guests'},
+     {'number_of_guests': ('3', 3)}),
+    ({'number_of_guests': ('2', 2)}, None, {'number_of_guests'}, {'number_of_guests': ('2', 2)}),
+])
+def test_merge_and_parse_values(new_entries, previous_entries, normalized, expected):
+    extractor = StateExtractor()
+    new_state = create_state(**new_entries)
+    previous_state = create_state(**previous_entries) if previous_entries is not None else None
+    state = asyncio.run(extractor._StateExtractor__merge_and_parse_values_async(new_state, previous_state,
+                                                                                 normalized))
+    assert state.to_dict() == create_state(**expected).to_dict()
+
+
+@pytest.mark.parametrize('table, expected', [
+    ("""| Date of arrival | 10th of November |
+| Duration of stay | 3 nights |
+| Number of guests | 2 |
+| Name of main guest | John Smith |
+| Email address | john@example.com |
+| Breakfast included? | Yes |
+| Did the user confirm a booking summary? | [not provided] |""",
+     {'date_of_arrival': '10th of November', 'duration_of_stay': '3 nights', 'number_of_guests': '2',
+      'name_of_main_guest': 'John Smith', 'email_address': 'john@example.com', 'breakfast_included': 'Yes',
+      'booking_confirmed': None}),
+    # rows without the outer pipes and a header
+    ("""Key | Value
+Date of arrival | tomorrow
+Number of guests | [not provided]""", {'date_of_arrival': 'tomorrow'}),
+    # keys worded differently are found by their keywords
+    ("""| Arrival date | 1.12. |
+| The duration | a week |
+| Email | I don't know |""", {'date_of_arrival': '1.12.', 'duration_of_stay': 'a week'}),
+    # only the first row of a slot counts, empty values are not provided
+    ("""| Number of guests | 2 |
+| Number of guests | 3 |
+| Name of main guest |  |""", {'number_of_guests': '2'}),
+    ("Sorry, I can't list the booking information.", {}),
+])
+def test_extract_raw_values(table, expected):
+    state = StateExtractor()._StateExtractor__extract_raw_values_from_chat_bot_response(table)
+    assert {attribute: entry.raw_value for attribute, entry in state.items()} == \
+           {attribute: expected.get(attribute) for attribute, _ in State().items()}